@@ -15,6 +15,7 @@ INSTALL_REQUIRES = [
     "sqlsoup",
     "sqlalchemy",
     "pyyaml",
+    "futures; python_version < '3'",
     "nose"
 ]
 
@@ -27,6 +28,7 @@ setup(
     packages=['sqlconmanager', 'sqlconmanager.resources', 'sqlconmanager.tests'],
     zip_safe=False,
     install_requires=INSTALL_REQUIRES,
+    extras_require={'gevent': ['gevent']},
     scripts=['sqlconmanager/connection_manager.py'],
     setup_requires=['nose'],
     test_suite='nose.collector',
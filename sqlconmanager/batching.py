@@ -0,0 +1,297 @@
+'''Write batching: gather small inserts/updates and write them in one transaction.'''
+
+import contextlib
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+from sqlconmanager import dialects
+from sqlconmanager.exceptions import ManagerConnectionException
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ROWS = 1000
+BATCH_MAX_BYTES = 1024 * 1024
+BATCH_MAX_DELAY = 1.0  # seconds
+BATCH_MAX_PENDING = 10000  # rows queued before writers are made to wait
+
+INSERT = "insert"
+UPDATE = "update"
+
+
+def _write_size(values):
+    '''Rough size of a row, good enough to bound the size of a batch.'''
+
+    return sum(len(str(value)) for value in values.values()) + 8 * len(values)
+
+
+def _group_writes(writes):
+    '''Group writes into executemany batches.
+
+    Writes to the same table keep their order: a batch is only extended while the table
+    sees the same kind of write on the same columns.  A table's batch runs at the
+    position of its first write.
+    '''
+
+    groups = []
+    open_groups = {}
+    for op, table, key, values in writes:
+        signature = (op, tuple(sorted(key)), tuple(sorted(values)))
+        group = open_groups.get(table)
+        if group is None or group[0] != signature:
+            group = (signature, table, [])
+            open_groups[table] = group
+            groups.append(group)
+        group[2].append((key, values))
+    return groups
+
+
+def execute_writes(connection, writes):
+    '''Execute (op, table, key, values) writes on connection, one executemany per batch.'''
+
+    for (op, key_columns, value_columns), table_name, rows in _group_writes(writes):
+        table = sqlalchemy.table(table_name, *[sqlalchemy.column(name) for name in key_columns + value_columns])
+        if op == INSERT:
+            connection.execute(table.insert(), [values for _, values in rows])
+        else:
+            statement = table.update().where(
+                sqlalchemy.and_(*[table.c[name] == sqlalchemy.bindparam('_key_' + name) for name in key_columns])
+            ).values(dict((name, sqlalchemy.bindparam('_value_' + name)) for name in value_columns))
+            params = []
+            for key, values in rows:
+                row = dict(('_key_' + name, value) for name, value in key.items())
+                row.update(('_value_' + name, value) for name, value in values.items())
+                params.append(row)
+            connection.execute(statement, params)
+
+
+@contextlib.contextmanager
+def _unlimited():
+    yield
+
+
+class BatchWriter(object):
+    '''Collect inserts and updates and flush them to the database as one transaction.
+
+    A flush happens when max_rows rows or max_bytes bytes are pending, when the oldest
+    pending write is max_delay seconds old, on flush() and on close().  Once max_pending
+    rows are waiting, insert()/update() block until a flush makes room (or raise after
+    put_timeout seconds).
+
+    Writes are durable once the flush that carries them has committed: flush() and
+    close() return only after that.  If the database cannot be reached (see
+    dialects.is_disconnect), the rows go back to the front of the queue and are retried
+    by the next flush; the error is raised by that flush() or, for flushes an
+    insert()/update() or the timer started, by the next insert()/update(), before it
+    queues its row.  When the database rejects the batch instead (a constraint
+    violation, say), its rows are replayed one at a time and the rejected ones are
+    logged and moved to `failed` (a list of (op, table, key, values) writes).  Rows that
+    still cannot be written when the writer is closed are moved to `failed` too and
+    close() raises.
+
+    on_commit, if given, is called with the list of (op, table, key, values) writes
+    of each committed flush.  admit, if given, returns a context manager entered around
+    each flush's transaction (the Manager passes its priority admission).
+    '''
+
+    def __init__(self, engine, max_rows=BATCH_MAX_ROWS, max_bytes=BATCH_MAX_BYTES, max_delay=BATCH_MAX_DELAY,
+                 max_pending=BATCH_MAX_PENDING, put_timeout=None, on_commit=None, admit=None):
+        self.engine = engine
+        self.on_commit = on_commit
+        self.admit = admit
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, max_rows)
+        self.put_timeout = put_timeout
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._oldest = None
+        self._error = None
+        self._closed = False
+        self.failed = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+        if max_delay:
+            self._timer = threading.Thread(target=self._run_timer, name='sqlconmanager-batch-writer')
+            self._timer.daemon = True
+            self._timer.start()
+
+    def insert(self, table, values):
+        '''Queue an insert of values (a column -> value dictionary) into table.'''
+
+        self._add((INSERT, table, {}, dict(values)))
+
+    def update(self, table, key, values):
+        '''Queue an update setting values on the row of table identified by key (column -> value).'''
+
+        self._add((UPDATE, table, dict(key), dict(values)))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _add(self, write):
+        size = _write_size(write[2]) + _write_size(write[3])
+        with self._cond:
+            if self._closed:
+                raise ManagerConnectionException('Batch writer is closed')
+            self._raise_error()
+
+            deadline = None if self.put_timeout is None else time.time() + self.put_timeout
+            while len(self._pending) >= self.max_pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise ManagerConnectionException('Batch writer queue full ({0} rows)'.format(len(self._pending)))
+                self._cond.wait(remaining)
+
+            if not self._pending:
+                self._oldest = time.time()
+                self._cond.notify_all()
+            self._pending.append(write)
+            self._pending_bytes += size
+            full = len(self._pending) >= self.max_rows or self._pending_bytes >= self.max_bytes
+
+        if full:
+            # The row is queued: a failed flush is reported by the next insert()/update().
+            try:
+                self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Flush failed: {0}'.format(exc))
+                with self._cond:
+                    self._error = exc
+
+    def flush(self):
+        '''Write everything pending in one transaction; return the number of rows written.
+
+        If the database cannot be reached, the rows are queued again (ahead of newer
+        writes) and the error is raised.  Rows the database rejects are moved to `failed`.
+        '''
+
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._pending_bytes = 0
+                self._oldest = None
+                self._cond.notify_all()
+
+            if not batch:
+                return 0
+
+            start = time.time()
+            try:
+                with self._admitted():
+                    written = self._write(batch)
+            except Exception:
+                self._requeue(batch)
+                raise
+            with self._cond:
+                self._error = None
+            if self.on_commit is not None and written:
+                self.on_commit(written)
+            logger.debug('Flushed {0} writes in {1:.3f}s'.format(len(written), time.time() - start))
+            return len(written)
+
+    def _admitted(self):
+        return _unlimited() if self.admit is None else self.admit()
+
+    def _is_rejection(self, exc):
+        return isinstance(exc, sqlalchemy.exc.DBAPIError) and \
+            not dialects.is_disconnect(self.engine.dialect.name, exc)
+
+    def _write(self, batch):
+        '''Write batch; return the writes committed.
+
+        A rejected batch is replayed one write at a time, the rejected writes going to
+        `failed`; any other error (an unreachable database) propagates.
+        '''
+
+        try:
+            with self.engine.begin() as connection:
+                execute_writes(connection, batch)
+            return batch
+        except sqlalchemy.exc.DBAPIError as exc:
+            if not self._is_rejection(exc):
+                raise
+
+        written = []
+        for index, write in enumerate(batch):
+            try:
+                with self.engine.begin() as connection:
+                    execute_writes(connection, [write])
+            except sqlalchemy.exc.DBAPIError as exc:
+                if not self._is_rejection(exc):
+                    # Keep what was written; the rest is queued again by flush().
+                    if self.on_commit is not None and written:
+                        self.on_commit(written)
+                    del batch[:index]
+                    raise
+                logger.error('Write to {0} rejected: {1}'.format(write[1], exc))
+                with self._cond:
+                    self.failed.append(write)
+            else:
+                written.append(write)
+        return written
+
+    def _requeue(self, batch):
+        with self._cond:
+            self._pending = batch + self._pending
+            self._pending_bytes = sum(_write_size(key) + _write_size(values) for _, _, key, values in self._pending)
+            # Retried by the timer after max_delay, or by the next flush.
+            self._oldest = time.time()
+            self._cond.notify_all()
+
+    def _run_timer(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                if self._oldest is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.max_delay - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+
+            try:
+                self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Background flush failed: {0}'.format(exc))
+                with self._cond:
+                    self._error = exc
+
+    def close(self):
+        '''Flush pending writes and stop the flush timer.
+
+        If the last flush fails, its rows are moved to `failed` and the error is raised.
+        '''
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._timer is not None:
+            self._timer.join()
+
+        try:
+            self.flush()
+        except Exception:
+            with self._cond:
+                self.failed.extend(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+                self._oldest = None
+            logger.error('Batch writer closed with {0} unwritten rows'.format(len(self.failed)))
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,157 @@
+'''Host-wide connection budget shared by every process using the same configuration.
+
+Each open connection holds an exclusive flock() on one of `limit` slot files, so all
+processes on the host together never open more than `limit` connections.  The kernel
+drops the locks of a process that dies, so slots cannot leak.
+'''
+
+import errno
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+
+from sqlconmanager.exceptions import ManagerConnectionException
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+BUDGET_TIMEOUT = 30  # seconds to wait for a free slot
+BUDGET_DEMAND_WINDOW = 5  # seconds a process waiting for a slot keeps asking others to shed idle connections
+
+
+class ConnectionBudget(object):
+    '''Cap the connections all processes on this host open to one database.
+
+    A process that finds no free slot signals demand (by touching a marker file) and
+    waits.  While demand is fresh, other processes close connections as they are
+    checked in, down to `reserve` idle connections, so busy processes borrow capacity
+    that idle ones are holding.
+    '''
+
+    def __init__(self, name, limit, lock_dir=None, timeout=BUDGET_TIMEOUT, reserve=0):
+        if fcntl is None:
+            raise ManagerConnectionException('Connection budgets need fcntl (POSIX)')
+        if limit < 1:
+            raise ManagerConnectionException('Connection budget for {0} must be at least 1'.format(name))
+
+        self.name = re.sub(r'[^\w.-]', '_', name)
+        self.limit = limit
+        self.lock_dir = lock_dir or tempfile.gettempdir()
+        self.timeout = timeout
+        self.reserve = reserve
+        self._held = {}
+        self._waiting = 0
+        self._waiting_lock = threading.Lock()
+        self._demand_path = os.path.join(self.lock_dir, 'sqlconmanager-{0}.demand'.format(self.name))
+
+    def _slot_path(self, slot):
+        return os.path.join(self.lock_dir, 'sqlconmanager-{0}.{1}.slot'.format(self.name, slot))
+
+    def _try_acquire(self):
+        start = random.randrange(self.limit)
+        for offset in range(self.limit):
+            slot_file = open(self._slot_path((start + offset) % self.limit), 'a')
+            try:
+                fcntl.flock(slot_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot_file
+            except IOError as exc:
+                slot_file.close()
+                if exc.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    raise
+        return None
+
+    def acquire(self):
+        '''Take a slot, waiting up to timeout seconds; return it (pass it to release()).'''
+
+        slot_file = self._try_acquire()
+        if slot_file is not None:
+            return slot_file
+
+        deadline = time.time() + self.timeout
+        delay = 0.01
+        with self._waiting_lock:
+            self._waiting += 1
+        try:
+            while True:
+                self._signal_demand()
+                if time.time() >= deadline:
+                    raise ManagerConnectionException('Connection budget for {0} exhausted ({1} connections)'.format(
+                        self.name, self.limit))
+                time.sleep(min(delay, max(deadline - time.time(), 0)))
+                delay = min(delay * 2, 0.5)
+
+                slot_file = self._try_acquire()
+                if slot_file is not None:
+                    return slot_file
+        finally:
+            with self._waiting_lock:
+                self._waiting -= 1
+
+    def release(self, slot_file):
+        '''Give a slot back.'''
+
+        try:
+            fcntl.flock(slot_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            slot_file.close()
+
+    def _signal_demand(self):
+        with open(self._demand_path, 'a'):
+            pass
+        os.utime(self._demand_path, None)
+
+    def in_demand(self):
+        '''True if another process has recently waited for a slot.'''
+
+        if self._waiting:
+            # This process is the one asking; shedding its own connections would not help.
+            return False
+        try:
+            return time.time() - os.path.getmtime(self._demand_path) < BUDGET_DEMAND_WINDOW
+        except OSError:
+            return False
+
+    def held(self):
+        '''Number of slots held by this process.'''
+
+        return len(self._held)
+
+    def attach(self, engine):
+        '''Make every connection engine opens hold a slot for its lifetime.'''
+
+        def on_do_connect(dialect, connection_record, cargs, cparams):
+            # A slot left over from a failed connect attempt is reused.
+            if 'budget_slot' not in connection_record.info:
+                connection_record.info['budget_slot'] = self.acquire()
+
+        def on_connect(dbapi_connection, connection_record):
+            self._held[id(dbapi_connection)] = connection_record.info.pop('budget_slot')
+
+        def on_close(dbapi_connection, *args):
+            slot_file = self._held.pop(id(dbapi_connection), None)
+            if slot_file is not None:
+                self.release(slot_file)
+
+        def on_checkin(dbapi_connection, connection_record):
+            if dbapi_connection is None or not self.in_demand():
+                return
+            pool = engine.pool
+            if hasattr(pool, 'checkedin') and pool.checkedin() >= self.reserve:
+                logger.debug('Releasing a {0} connection to a waiting process'.format(self.name))
+                connection_record.invalidate()
+
+        sqlalchemy.event.listen(engine, 'do_connect', on_do_connect)
+        sqlalchemy.event.listen(engine, 'connect', on_connect)
+        sqlalchemy.event.listen(engine, 'close', on_close)
+        sqlalchemy.event.listen(engine, 'close_detached', on_close)
+        sqlalchemy.event.listen(engine, 'checkin', on_checkin)
@@ -0,0 +1,170 @@
+'''Bulk reads: key lookups (chunked IN lists run in parallel, or a temporary-table join)
+and keyset-paginated scans.'''
+
+import itertools
+import logging
+
+import sqlalchemy
+
+from concurrent import futures
+
+from sqlconmanager import dialects
+
+logger = logging.getLogger(__name__)
+
+IN_CHUNK_SIZE = 1000  # keys per IN list; larger lists rarely plan better
+FETCH_WORKERS = 4
+TEMP_TABLE_THRESHOLD = 20000  # above this many keys, join against a temporary table instead
+PAGE_SIZE = 1000
+
+_temp_table_ids = itertools.count()
+
+
+def _chunks(keys, size):
+    for start in range(0, len(keys), size):
+        yield keys[start:start + size]
+
+
+def _fetch_chunk(engine, table, column, keys):
+    connection = engine.connect()
+    try:
+        return connection.execute(sqlalchemy.select([table]).where(table.c[column].in_(keys))).fetchall()
+    finally:
+        connection.close()
+
+
+def fetch_chunked(engine, table, column, keys, chunk_size=IN_CHUNK_SIZE, workers=FETCH_WORKERS):
+    '''Yield the rows of table whose column is in keys, running IN-list chunks in parallel.
+
+    At most 2 * workers chunks are in flight, so memory stays bounded; rows are yielded
+    as each chunk completes, not in key order.
+    '''
+
+    chunks = _chunks(keys, chunk_size)
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+    try:
+        for chunk in itertools.islice(chunks, 2 * workers):
+            pending.add(executor.submit(_fetch_chunk, engine, table, column, chunk))
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for chunk in itertools.islice(chunks, len(done)):
+                pending.add(executor.submit(_fetch_chunk, engine, table, column, chunk))
+            for future in done:
+                for row in future.result():
+                    yield row
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def fetch_joined(engine, table, column, keys, chunk_size=IN_CHUNK_SIZE):
+    '''Yield the rows of table whose column is in keys, by bulk-loading the keys into a
+    temporary table and streaming the join (in a transaction, see dialects.streaming).
+
+    Raises sqlalchemy.exc.DBAPIError if the temporary table cannot be created (for example
+    without the CREATE TEMPORARY TABLES privilege).
+    '''
+
+    key_table = sqlalchemy.Table('sqlconmanager_keys_{0}'.format(next(_temp_table_ids)), sqlalchemy.MetaData(),
+                                 sqlalchemy.Column('k', table.c[column].type, primary_key=True),
+                                 prefixes=['TEMPORARY'])
+    connection = dialects.streaming(engine.connect())
+    try:
+        key_table.create(connection)
+        try:
+            with connection.begin():
+                for chunk in _chunks(keys, chunk_size):
+                    connection.execute(key_table.insert(), [{'k': key} for key in chunk])
+
+            query = sqlalchemy.select([table]).select_from(table.join(key_table, table.c[column] == key_table.c.k))
+            with connection.begin():
+                result = connection.execution_options(stream_results=True).execute(query)
+                try:
+                    for row in result:
+                        yield row
+                finally:
+                    # Before the drop: MySQL cannot run it while an unbuffered result is open.
+                    result.close()
+        finally:
+            key_table.drop(connection)
+    finally:
+        connection.close()
+
+
+def _nullable(column):
+    # Primary keys cannot be NULL, whatever reflection says (SQLite reports them nullable).
+    return column.nullable and not column.primary_key
+
+
+def _after(key_columns, after):
+    '''Keyset predicate: rows ordered after the key values in after.
+
+    NULLs sort first (see iter_pages) and compare equal to each other, which a row value
+    comparison cannot express, so nullable keys get the expanded form
+    (k1 > a1) OR (k1 = a1 AND k2 > a2) OR ...
+    '''
+
+    if not any(_nullable(column) for column in key_columns):
+        if len(key_columns) == 1:
+            return key_columns[0] > after[0]
+        return sqlalchemy.tuple_(*key_columns) > sqlalchemy.tuple_(*after)
+
+    alternatives = []
+    equal = []
+    for column, value in zip(key_columns, after):
+        if value is None:
+            alternatives.append(sqlalchemy.and_(*(equal + [column.isnot(None)])))
+            equal.append(column.is_(None))
+        else:
+            alternatives.append(sqlalchemy.and_(*(equal + [column > value])))
+            equal.append(column == value)
+    return sqlalchemy.or_(*alternatives)
+
+
+def _fetch_page(engine, query, key_columns, after):
+    if after is not None:
+        query = query.where(_after(key_columns, after))
+    connection = engine.connect()
+    try:
+        return connection.execute(query).fetchall()
+    finally:
+        connection.close()
+
+
+def iter_pages(engine, table, key, page_size=PAGE_SIZE, where=None, prefetch=True):
+    '''Yield the rows of table matching where in pages of page_size, ordered by key.
+
+    key is a column name or a list of them; the primary key columns are added to make
+    the order unique.  Each page seeks past the last key of the previous one (keyset
+    pagination), so late pages cost the same as early ones with an index on key.  Rows
+    whose nullable key columns are NULL come first, on every dialect (see
+    dialects.nulls_first); the predicate for nullable keys makes less use of an index.  With prefetch, the next page is fetched
+    in a background thread while the caller works on the current one.
+    '''
+
+    names = [key] if isinstance(key, sqlalchemy.util.string_types) else list(key)
+    key_columns = [table.c[name] for name in names]
+    key_columns += [column for column in table.primary_key.columns if column.name not in names]
+
+    order_by = [dialects.nulls_first(engine.dialect.name, column) if _nullable(column) else column
+                for column in key_columns]
+    query = sqlalchemy.select([table]).order_by(*order_by).limit(page_size)
+    if where is not None:
+        query = query.where(where)
+
+    executor = futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = _fetch_page(engine, query, key_columns, None)
+        while page:
+            if len(page) < page_size:
+                yield page
+                return
+            after = tuple(page[-1][column] for column in key_columns)
+            following = None if executor is None else executor.submit(_fetch_page, engine, query, key_columns, after)
+            yield page
+            page = _fetch_page(engine, query, key_columns, after) if following is None else following.result()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
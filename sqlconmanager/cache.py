@@ -0,0 +1,86 @@
+'''Process-level entity cache for primary-key lookups.'''
+
+import collections
+import threading
+import time
+
+ENTITY_CACHE_SIZE = 10000  # entries
+ENTITY_CACHE_TTL = 60  # seconds
+GENERATION_SLOTS = 1024  # keys share invalidation counters by hash, to bound memory
+
+MISSING = object()
+
+
+class EntityCache(object):
+    '''LRU cache with a time-to-live, keyed by (config, table, primary key tuple).'''
+
+    def __init__(self, max_entries=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cleared = 0
+        self._table_generations = {}
+        self._key_generations = [0] * GENERATION_SLOTS
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return the cached value for key, or MISSING.'''
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return MISSING
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, key):
+        '''Invalidation counters of key, to read before loading its value (see put).'''
+
+        with self._lock:
+            return self._generation(key)
+
+    def _generation(self, key):
+        return (self._cleared, self._table_generations.get(key[:2], 0),
+                self._key_generations[hash(key) % GENERATION_SLOTS])
+
+    def put(self, key, value, generation=None):
+        '''Cache value under key.
+
+        Pass the generation(key) read before loading value: if key, its table or the
+        whole cache was invalidated since, value may be stale and is not cached.
+        Invalidations of other keys and tables do not count (except for keys sharing a
+        counter slot).
+        '''
+
+        with self._lock:
+            if generation is not None and generation != self._generation(key):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._key_generations[hash(key) % GENERATION_SLOTS] += 1
+            self._entries.pop(key, None)
+
+    def invalidate_table(self, config, table):
+        '''Drop every entry of a table.'''
+
+        with self._lock:
+            self._table_generations[(config, table)] = self._table_generations.get((config, table), 0) + 1
+            for key in [key for key in self._entries if key[0] == config and key[1] == table]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._cleared += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
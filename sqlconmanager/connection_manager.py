@@ -1,12 +1,44 @@
 #!/bin/env python
 '''SQLSoup-based connection manager and unit tests.'''
 
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
 import logging
-import sqlsoup
+import sys
+import threading
+import time
+import weakref
 import sqlalchemy
+import sqlalchemy.orm
 import yaml
 import pkg_resources
 
+from sqlconmanager import batching
+from sqlconmanager import bulk
+from sqlconmanager import green
+from sqlconmanager import priority as priorities
+from sqlconmanager import reflection
+from sqlconmanager import retry
+from sqlconmanager import dialects
+from sqlconmanager import transfer
+from sqlconmanager.batching import BatchWriter
+from sqlconmanager.budget import ConnectionBudget
+from sqlconmanager.cache import EntityCache, MISSING
+from sqlconmanager.exceptions import ManagerConnectionException
+from sqlconmanager.failover import HostSelector, parse_hosts
+from sqlconmanager.identity import IdentityMapLimit, IDENTITY_MAP_SIZE
+from sqlconmanager.lazy import LazySoup
+from sqlconmanager.maintenance import PoolMaintainer
+from sqlconmanager.mirror import TableMirror
+from sqlconmanager.pipeline import Pipeline
+from sqlconmanager.spool import WriteSpool
+from sqlconmanager.leaks import LeakDetector, LEAK_SAMPLE_RATE, LEAK_THRESHOLD
+from sqlconmanager.sharding import ShardMap
+from sqlconmanager.tagging import SqlTagger
+
 logger = logging.getLogger(__name__)
 
 #######################################################################################
@@ -29,24 +61,78 @@ class ConnectionLevel:  # pylint: disable=C1001
     ADMIN = "admin"
 
 
-class ManagerConnectionException(Exception):
-    pass
-
-
 POOL_SIZE = 10
 MAX_OVERFLOW = 10
 DB_CONNECT_TIMEOUT = 30  # seconds
 RECYCLE_CONNECTION_TIMEOUT = 1800  # seconds
+DEFAULT_SHARD_MAP = "default"
+
+# Statement timeout (seconds) per security level; None leaves the server default.
+# A configuration can override these with a statement_timeouts mapping in dbconfig.yaml.
+STATEMENT_TIMEOUTS = {
+    ConnectionLevel.READ_ONLY: None,
+    ConnectionLevel.UPDATE: None,
+    ConnectionLevel.ADMIN: None,
+}
+
+# Checkout priority per security level, for configurations with a priority section.
+LEVEL_PRIORITIES = {
+    ConnectionLevel.ADMIN: priorities.HIGH,
+    ConnectionLevel.UPDATE: priorities.NORMAL,
+    ConnectionLevel.READ_ONLY: priorities.LOW,
+}
 
 
 class Manager(object):
+    '''Connection manager.
 
-    def __init__(self):
-        self.config_stream = None
+    With script_mode=True the Manager is tuned for short-lived scripts that run a few
+    queries and exit: engines do not pool (NullPool), get_connection skips the
+    "select 1" validation and returns a LazySoup, and close() (or leaving a
+    `with Manager(...) as mgr:` block) tears everything down.
+
+    With cooperative=True the Manager is meant for gevent servers (after
+    gevent.monkey.patch_all()): pools hand out connections to waiting greenlets in
+    arrival order without blocking the hub, the postgres driver yields while queries
+    run, and connection validation gives up after DB_CONNECT_TIMEOUT.
+    '''
+
+    def __init__(self, config_stream=None, script_mode=False, cooperative=False):
+        self.config_stream = config_stream
+        self.script_mode = script_mode
+        self.cooperative = cooperative
+        if cooperative:
+            green.require_gevent()
         self.database_configuration = "dev_test"
         self.database_echo = False
+        self.pool_echo = True  # SQLAlchemy prints pool events to stdout
         self.db_engine = None
         self.db_configs = None
+        self.db_engines = {}
+        self.shard_maps = None
+        self._shard_connections = {}
+        self._engine_lock = threading.Lock()
+        self._engine_keys = weakref.WeakKeyDictionary()
+        self.leak_detector = None
+        self.sql_tagger = None
+        self._budgets = {}
+        self._host_selectors = {}
+        self._priority_gates = {}
+        self.maintainer = None
+        self.entity_cache = EntityCache()
+        self.identity_limit = None
+        self.spool = None
+        self.retry_stats = retry.RetryStats()
+        self._mirrors = {}
+        self._entity_connections = {}
+        self._entity_lock = threading.Lock()
+        self._session_factory = sqlalchemy.orm.sessionmaker(class_=reflection.SharedSession)
+        # Thread-local session of the get_connection/for_key handles (see release()).
+        self._session = sqlalchemy.orm.scoped_session(self._session_factory)
+        # id(engine) -> unbound MetaData, dropped along with the engine (see _forget_engine).
+        self._engine_metadata = {}
+        self._reflection_lock = threading.Lock()
+        self._track_session_writes(self._session_factory)
 
     def get_connection_config_list(self):
         ''' Return list of known DB connection configuration names.  Useful for iteration'''
@@ -58,20 +144,16 @@ class Manager(object):
     def _load_configs(self):
         if self.db_configs is None:
             try:
-                self.db_configs = yaml.load(self.config_stream)
+                self.db_configs = yaml.safe_load(self.config_stream)
                 logger.debug('Successfully loaded supplied configuration yaml')
             except Exception as exc:
                 # if config_stream is not set or is an invalid file, use the packaged dbconfig file
                 logger.info('Loading packaged yaml')
-                self.db_configs = yaml.load(pkg_resources.resource_stream('sqlconmanager', 'resources/dbconfig.yaml'))
+                self.db_configs = yaml.safe_load(pkg_resources.resource_stream('sqlconmanager', 'resources/dbconfig.yaml'))
 
 
-    def get_engine(self, config_name=None, security_level=ConnectionLevel.READ_ONLY, force_flag=False):
-        '''Get engine (engine is the home base for SQLAlchemy - a dialect and a connection pool.'''
-
-        if self.db_engine is not None and force_flag is not True:
-            logging.info('db engine already set, returning db engine')
-            return self.db_engine
+    def _create_engine(self, config_name=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Create a new engine for a configuration/security level.'''
 
         if not config_name:
             config_name = self.database_configuration
@@ -83,29 +165,123 @@ class Manager(object):
         try:
             logger.debug('Configuration: {0}'.format(self.db_configs))
             conn_config = self.db_configs['database_configurations'][config_name]
-            (username, password) = conn_config['credentials'][security_level]
+            if dialects.dialect_name(conn_config['dbtype']) == dialects.SQLITE:
+                # SQLite has no accounts; READ_ONLY is enforced with the query_only pragma.
+                (username, password) = (None, None)
+            else:
+                (username, password) = conn_config['credentials'][security_level]
         except KeyError:
             logger.error('Unable to find the {0} credentials for "{1}")'.format(config_name, security_level))
             raise ManagerConnectionException('No credentials for {0}:{1}'.format(config_name, security_level))
 
-        connstring = '{0}://{1}:{2}@{3}:{4}/{5}'.format(conn_config['dbtype'], username,
-                                                        password,
-                                                        conn_config["host"],
-                                                        conn_config["port"],
-                                                        conn_config["dbname"])
+        selector = self._get_host_selector(config_name, conn_config)
+        if selector is not None:
+            # The URL names one host; the selector picks the one actually connected to.
+            conn_config = dict(conn_config, host=selector.hosts[0][0], port=selector.hosts[0][1])
+        connstring = dialects.connection_url(conn_config, username, password)
 
         logger.debug("Connection: {0}".format(connstring))
 
-        self.db_engine = sqlalchemy.create_engine(connstring,
-                                                  pool_size=POOL_SIZE,
-                                                  max_overflow=MAX_OVERFLOW,
-                                                  echo=self.database_echo, echo_pool=True,
-                                                  pool_recycle=RECYCLE_CONNECTION_TIMEOUT)
+        try:
+            options, pragmas = dialects.engine_options(conn_config, security_level == ConnectionLevel.READ_ONLY,
+                                                       {'pool_size': POOL_SIZE,
+                                                        'max_overflow': MAX_OVERFLOW,
+                                                        'pool_recycle': RECYCLE_CONNECTION_TIMEOUT})
+        except ValueError as exc:
+            raise ManagerConnectionException('Invalid engine_options for {0}: {1}'.format(config_name, exc))
+        if self.script_mode:
+            options = dialects.unpooled(conn_config, options)
+        if self.cooperative:
+            green.green_driver(conn_config['dbtype'])
+            options = green.engine_options(options)
+        engine = sqlalchemy.create_engine(connstring, echo=self.database_echo, echo_pool=self.pool_echo, **options)
+        self._configure_engine(engine, conn_config, config_name, security_level, pragmas)
+
+        return engine
+
+    def _configure_engine(self, engine, conn_config, config_name, security_level, pragmas=None):
+        '''Install per-connection setup (statement timeout, pragmas) on a new engine.'''
+
+        timeouts = conn_config.get('statement_timeouts') or {}
+        statement_timeout = timeouts.get(security_level, STATEMENT_TIMEOUTS.get(security_level))
+        dialects.install_session_setup(engine, dialects.dialect_name(conn_config['dbtype']), statement_timeout,
+                                       pragmas)
+
+        budget = self._get_budget(config_name, conn_config)
+        if budget is not None:
+            budget.attach(engine)
+        # After the budget: its do_connect listener only takes a slot, this one connects.
+        selector = self._get_host_selector(config_name, conn_config)
+        if selector is not None:
+            selector.attach(engine)
+
+        self._engine_keys[engine] = (config_name, security_level)
+        if self.leak_detector is not None:
+            self.leak_detector.attach(engine, '{0}:{1}'.format(config_name, security_level))
+        if self.sql_tagger is not None:
+            self.sql_tagger.attach(engine, config_name, security_level)
+
+    def _get_budget(self, config_name, conn_config):
+        '''Return the host-wide connection budget of a configuration, if it declares one.
+
+        The budget is shared by all security levels: they count against the same server limit.
+        '''
+
+        spec = conn_config.get('connection_budget')
+        if not spec:
+            return None
+
+        budget = self._budgets.get(config_name)
+        if budget is None:
+            name = '{0}-{1}-{2}'.format(config_name, conn_config.get('host', 'local'), conn_config.get('dbname'))
+            try:
+                budget = ConnectionBudget(name, **spec)
+            except TypeError as exc:
+                raise ManagerConnectionException('Invalid connection_budget for {0}: {1}'.format(config_name, exc))
+            self._budgets[config_name] = budget
+        return budget
+
+    def _get_host_selector(self, config_name, conn_config):
+        '''Return the host selector of a configuration that lists several hosts, starting its probes.'''
+
+        hosts = conn_config.get('hosts')
+        if not hosts:
+            return None
+
+        selector = self._host_selectors.get(config_name)
+        if selector is None:
+            try:
+                selector = HostSelector(config_name, parse_hosts(hosts, conn_config.get('port')),
+                                        **(conn_config.get('failover') or {}))
+            except (TypeError, ValueError, KeyError) as exc:
+                raise ManagerConnectionException('Invalid hosts for {0}: {1}'.format(config_name, exc))
+            selector.start()
+            self._host_selectors[config_name] = selector
+        return selector
+
+    def get_engine(self, config_name=None, security_level=ConnectionLevel.READ_ONLY, force_flag=False):
+        '''Get engine (engine is the home base for SQLAlchemy - a dialect and a connection pool.'''
+
+        if self.db_engine is not None and force_flag is not True:
+            logging.info('db engine already set, returning db engine')
+            return self.db_engine
+
+        if self.db_engine is not None:
+            self._forget_engine(self.db_engine)
+        self.db_engine = self._create_engine(config_name, security_level)
 
         return self.db_engine
 
-    def get_connection(self, config_stream, config=None, security_level=ConnectionLevel.READ_ONLY, sql_echo=False):
-        '''Return the SQLSoup connection to the server/access level of your choice'''
+    def get_connection(self, config_stream, config=None, security_level=ConnectionLevel.READ_ONLY, sql_echo=False,
+                       validate=False):
+        '''Return the SQLSoup connection to the server/access level of your choice
+
+        The connection is a LazySoup: nothing is checked out or reflected until it is used.
+        On first use of a table (or anything but execute()) the connection is validated
+        with a "select 1" round trip, and the engine is recreated if that fails; raw
+        execute() calls skip both.  With validate=True the validation happens here and a
+        real SQLSoup is returned.  In script mode there is no validation.
+        '''
 
         self.database_echo = sql_echo
 
@@ -113,18 +289,26 @@ class Manager(object):
         logger.debug('Using config stream: {0}'.format(self.config_stream))
         an_engine = self.get_engine(config, security_level)
 
-        is_valid_connection = False
+        if self.script_mode:
+            # A bad server shows up on the first query instead.
+            return LazySoup(an_engine, self._soup, session=self._session)
+        if not validate:
+            return LazySoup(an_engine, self._soup, prepare=lambda db: self._validated(db, config, security_level),
+                            session=self._session)
+
+        db = self._validated(self._soup(an_engine), config, security_level)
+        logger.debug('Returning database instance: {0}'.format(db))
+        return db
+
+    def _validated(self, db, config, security_level):
+        '''Validate db, recreating the engine once if that fails; return the SQLSoup to use.'''
 
         try:
-            db = sqlsoup.SQLSoup(an_engine)
             is_valid_connection = self.validate_connection(db)
             logger.debug("Validating connection..isvalid: {0}".format(is_valid_connection))
         except Exception as e:
             logger.error("invalid connection, try reconnect of engine: {0}".format(e))
-            an_engine = self.get_engine(config, security_level, force_flag=True)
-            db = sqlsoup.SQLSoup(an_engine)
-
-        if is_valid_connection is False:
+            db = self._soup(self.get_engine(config, security_level, force_flag=True))
             try:
                 self.validate_connection(db)
             except Exception:
@@ -132,16 +316,16 @@ class Manager(object):
                 raise ManagerConnectionException('Bad server {0}; failed on reconnect'.format(config))
 
         db.echo = True
-
-        logger.debug('Returning database instance: {0}'.format(db))
-
         return db
 
     def validate_connection(self, db):
         ''' Throws exception on invalid connection.'''
 
         logger.debug("Executing select 1")
-        db.connection().execute("select 1")
+        if self.cooperative:
+            green.validate(db.connection(), DB_CONNECT_TIMEOUT)
+        else:
+            db.connection().execute("select 1")
         return True
 
     def set_db_config(self, db_string):
@@ -158,4 +342,931 @@ class Manager(object):
         '''Unset (disconnect) the SQLAlchemy engine.'''
 
         logger.info("unset_engine")
-        self.db_engine = None
\ No newline at end of file
+        if self.db_engine is not None:
+            self._forget_engine(self.db_engine)
+        self.db_engine = None
+
+    def _forget_engine(self, engine):
+        '''Drop what this Manager keeps for an engine it no longer uses, so it can be collected.'''
+
+        with self._reflection_lock:
+            self._engine_metadata.pop(id(engine), None)
+        with self._entity_lock:
+            self._entity_connections = {}
+
+    def _engine_for(self, config_name=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Return the engine for a configuration/security level, creating it on first use.
+
+        Unlike get_engine, engines are kept per configuration, so several databases can be
+        used side by side.
+        '''
+
+        if not config_name:
+            config_name = self.database_configuration
+
+        key = (config_name, security_level)
+        engine = self.db_engines.get(key)
+        if engine is None:
+            with self._engine_lock:
+                engine = self.db_engines.get(key)
+                if engine is None:
+                    engine = self._create_engine(config_name, security_level)
+                    self.db_engines[key] = engine
+        return engine
+
+    def _load_shard_maps(self):
+        if self.shard_maps is None:
+            self._load_configs()
+            shard_maps = {}
+            try:
+                for name, spec in (self.db_configs.get('shard_maps') or {}).items():
+                    shard_maps[name] = ShardMap.from_config(name, spec)
+            except (ValueError, TypeError, AttributeError, IndexError) as exc:
+                raise ManagerConnectionException('Invalid shard map configuration: {0}'.format(exc))
+            known = set(self.get_connection_config_list())
+            for name, shard_map in shard_maps.items():
+                unknown = shard_map.config_names() - known
+                if unknown:
+                    raise ManagerConnectionException('Shard map {0} routes to unknown configurations: {1}'.format(
+                        name, ', '.join(sorted(unknown))))
+            self.shard_maps = shard_maps
+        return self.shard_maps
+
+    def _get_shard_map(self, shard_map):
+        try:
+            return self._load_shard_maps()[shard_map]
+        except KeyError:
+            raise ManagerConnectionException('Unknown shard map {0}.'.format(shard_map))
+
+    def shard_for(self, key, shard_map=DEFAULT_SHARD_MAP):
+        '''Return the name of the database configuration holding key.'''
+
+        try:
+            return self._get_shard_map(shard_map).lookup(key)
+        except KeyError as exc:
+            raise ManagerConnectionException(str(exc))
+
+    def for_key(self, key, security_level=ConnectionLevel.READ_ONLY, shard_map=DEFAULT_SHARD_MAP):
+        '''Return the SQLSoup connection for the shard holding key.
+
+        Connections are built once per shard/security level and reused, so routing is a dictionary
+        lookup once every shard has been visited.  They are shared by every thread; each thread
+        works in its own session (see release()).
+        '''
+
+        config_name = self.shard_for(key, shard_map)
+        cache_key = (config_name, security_level)
+        db = self._shard_connections.get(cache_key)
+        if db is None:
+            # Threads racing here keep the first handle stored.
+            db = self._shard_connections.setdefault(cache_key,
+                                                    self._soup(self._engine_for(config_name, security_level)))
+        return db
+
+    def move_shard(self, shard, config_name, shard_map=DEFAULT_SHARD_MAP):
+        '''Route a shard (hash bucket, or range lower bound) to another configuration while running.'''
+
+        if config_name not in self.get_connection_config_list():
+            raise ManagerConnectionException('Unknown database configuration {0}.'.format(config_name))
+
+        try:
+            self._get_shard_map(shard_map).move(shard, config_name)
+        except (KeyError, IndexError, ValueError) as exc:
+            raise ManagerConnectionException('Cannot move shard {0}: {1}'.format(shard, exc))
+
+    def batch_writer(self, config=None, security_level=ConnectionLevel.UPDATE, priority=None, **thresholds):
+        '''Return a BatchWriter that groups small inserts/updates into one transaction per flush.
+
+        thresholds are passed to BatchWriter (max_rows, max_bytes, max_delay, max_pending, put_timeout).
+        Call close() (or use it as a context manager) to flush the last batch.  With a
+        priority section in the configuration, each flush waits for a slot (priority as
+        for connection()).
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        return BatchWriter(self._engine_for(config, security_level),
+                           on_commit=lambda writes: self._invalidate_writes(config, writes),
+                           admit=lambda: self._admitted(config, security_level, priority), **thresholds)
+
+    def _invalidate_writes(self, config, writes):
+        '''Invalidate the entity cache for committed (op, table, key, values) writes.'''
+
+        for op, table, key, _ in writes:
+            if op == batching.UPDATE:
+                self._invalidate_entity(config, table, key)
+
+    def enable_spool(self, path, **settings):
+        '''Spool write() calls to a local SQLite file at path while their database is unreachable.
+
+        Spooled writes (including any left in path by a previous run) are drained in order
+        by a background thread once the database answers.  settings: batch_size,
+        probe_interval.  See WriteSpool for the delivery guarantees.
+        '''
+
+        if self.spool is None:
+            self.spool = WriteSpool(path, self._engine_for, on_commit=self._invalidate_writes, **settings)
+        return self.spool
+
+    def write(self, table, values, key=None, config=None, security_level=ConnectionLevel.UPDATE):
+        '''Insert values into table, or update the row identified by key (a column -> value dict).
+
+        With a spool enabled, a write that cannot reach the database is spooled instead of
+        failing; returns True if the write reached the database, False if it was spooled.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        op = batching.INSERT if key is None else batching.UPDATE
+        key = dict(key or {})
+        values = dict(values)
+        if self.spool is not None:
+            return self.spool.write(config, security_level, op, table, key, values)
+
+        writes = [(op, table, key, values)]
+        with self._engine_for(config, security_level).begin() as connection:
+            batching.execute_writes(connection, writes)
+        self._invalidate_writes(config, writes)
+        return True
+
+    def backend_id(self, db):
+        '''Return the server-side id (MySQL thread id, Postgres backend pid) of a connection.
+
+        db is a SQLSoup handle or a SQLAlchemy Connection; pass the id to cancel() from
+        another thread to stop the statement it is running.  The first call for a pooled
+        connection looks the id up with a query on it (so call it before starting the
+        statement); later ones are free.  For configurations with
+        several hosts the id is a dialects.BackendId that also records the host the
+        connection went to.
+        '''
+
+        connection = db if isinstance(db, sqlalchemy.engine.Connection) else db.connection()
+        backend_id = dialects.backend_id(connection.dialect.name, connection)
+        host = connection.connection.info.get('host')
+        if backend_id is None or host is None:
+            return backend_id
+        return dialects.BackendId(backend_id, host)
+
+    def cancel(self, backend_id, config=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Cancel the statement running on a server connection (see backend_id).
+
+        The cancelled statement fails in the thread that issued it; that thread's rollback
+        returns the connection to the pool.  The cancel is sent to the host the connection
+        went to, which backend_id records for configurations with several hosts.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        self._load_configs()
+        try:
+            conn_config = self.db_configs['database_configurations'][config]
+            dbtype = conn_config['dbtype']
+        except KeyError:
+            raise ManagerConnectionException('Unknown database configuration {0}.'.format(config))
+
+        host = getattr(backend_id, 'host', None)
+        if host is None and len(conn_config.get('hosts') or ()) > 1:
+            # Ids are per server: cancelling on a guessed host could stop an unrelated statement.
+            raise ManagerConnectionException('Backend id {0} does not say which host of {1} it is on; '
+                                             'pass the value returned by backend_id()'.format(backend_id, config))
+
+        logger.info('Cancelling statement on backend {0} ({1})'.format(backend_id, config))
+        try:
+            dialects.cancel_statement(self._engine_for(config, security_level), dialects.dialect_name(dbtype),
+                                      backend_id, host)
+        except NotImplementedError as exc:
+            raise ManagerConnectionException(str(exc))
+
+    def enable_leak_detection(self, threshold=LEAK_THRESHOLD, sample_rate=LEAK_SAMPLE_RATE):
+        '''Track checkouts on all engines of this Manager and flag connections held > threshold seconds.
+
+        A stack is captured for a sample_rate fraction of checkouts, so the call sites of
+        leaked connections can be reported (see leak_report).
+        '''
+
+        if self.leak_detector is not None:
+            self.leak_detector.threshold = threshold
+            self.leak_detector.sample_rate = sample_rate
+            return self.leak_detector
+
+        self.leak_detector = LeakDetector(threshold=threshold, sample_rate=sample_rate)
+        for engine, (config_name, security_level) in list(self._engine_keys.items()):
+            self.leak_detector.attach(engine, '{0}:{1}'.format(config_name, security_level))
+        return self.leak_detector
+
+    def pool_stats(self):
+        '''One dictionary of pool metrics per engine of this Manager.'''
+
+        stats = []
+        for engine, (config_name, security_level) in sorted(self._engine_keys.items(), key=lambda item: item[1]):
+            pool = engine.pool
+            entry = collections.OrderedDict([('config', config_name), ('level', security_level),
+                                             ('pool', type(pool).__name__)])
+            for metric in ('size', 'checkedin', 'checkedout', 'overflow'):
+                if hasattr(pool, metric):
+                    entry[metric] = getattr(pool, metric)()
+            budget = self._budgets.get(config_name)
+            if budget is not None:
+                entry['budget_held'] = budget.held()
+            selector = self._host_selectors.get(config_name)
+            if selector is not None:
+                entry['host'] = '{0}:{1}'.format(*selector.preferred)
+            stats.append(entry)
+        return stats
+
+    def leak_report(self, limit=10):
+        '''Log connections held beyond the leak threshold and the top leaking call sites.'''
+
+        if self.leak_detector is None:
+            raise ManagerConnectionException('Leak detection is not enabled')
+        return self.leak_detector.report(limit)
+
+    def enable_sql_tags(self, service, call_site=True):
+        '''Append to every statement run through this Manager's engines a comment naming
+        service, the configuration, the security level and (with call_site) the calling
+        file, line and function, for the server's slow query log and statement statistics.
+        executemany batches are not tagged (see SqlTagger).
+
+        Only engines created from now on are tagged, so call this before the first query.
+        '''
+
+        if self.sql_tagger is None:
+            self.sql_tagger = SqlTagger(service, call_site)
+        return self.sql_tagger
+
+    def limit_identity_maps(self, max_objects=IDENTITY_MAP_SIZE, expunge_on_commit=False):
+        '''Bound the identity maps of the sessions behind this Manager's SQLSoup handles
+        (other SQLSoup users in the process are not affected).
+
+        Once a session holds max_objects loaded objects, the least recently loaded clean
+        ones are expunged; with expunge_on_commit each commit empties the session.  Long
+        running workers keep flat memory this way.  Calling again changes the settings.
+        See identity_map_size for monitoring.
+        '''
+
+        if self.identity_limit is None:
+            self.identity_limit = IdentityMapLimit(max_objects, expunge_on_commit)
+            self.identity_limit.attach(self._session_factory)
+        else:
+            self.identity_limit.max_objects = max_objects
+            self.identity_limit.expunge_on_commit = expunge_on_commit
+        return self.identity_limit
+
+    def identity_map_size(self, db=None):
+        '''Objects in the identity map of db's session for this thread (default: get_connection's).'''
+
+        session = self._session() if db is None else db.session()
+        return len(session.identity_map)
+
+    def _new_connection(self, config=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Return a SQLSoup handle with its own session registry, so it can be released on its own.'''
+
+        return self._soup(self._engine_for(config, security_level),
+                          session=sqlalchemy.orm.scoped_session(self._session_factory))
+
+    def _get_priority_gate(self, config):
+        '''Return the priority gate of a configuration with a priority section, or None.'''
+
+        if not config:
+            config = self.database_configuration
+
+        with self._engine_lock:
+            if config in self._priority_gates:
+                return self._priority_gates[config]
+
+            self._load_configs()
+            spec = dict((self.db_configs['database_configurations'].get(config) or {}).get('priority') or {})
+            gate = None
+            if spec:
+                reserved = dict((LEVEL_PRIORITIES.get(level, level), slots)
+                                for level, slots in (spec.pop('reserved', None) or {}).items())
+                try:
+                    gate = priorities.PriorityGate(config, spec.pop('capacity', POOL_SIZE + MAX_OVERFLOW), reserved,
+                                                   **spec)
+                except TypeError as exc:
+                    raise ManagerConnectionException('Invalid priority for {0}: {1}'.format(config, exc))
+            self._priority_gates[config] = gate
+            return gate
+
+    @contextlib.contextmanager
+    def _admitted(self, config, security_level, priority):
+        gate = self._get_priority_gate(config)
+        if gate is None:
+            yield
+            return
+
+        gate.acquire(LEVEL_PRIORITIES.get(security_level, priorities.NORMAL) if priority is None else priority)
+        try:
+            yield
+        finally:
+            gate.release()
+
+    @contextlib.contextmanager
+    def connection(self, config=None, security_level=ConnectionLevel.READ_ONLY, priority=None):
+        '''Yield a SQLSoup connection that goes back to the pool when the block exits.
+
+        Uncommitted changes are rolled back on exit; use transaction() to commit.
+
+            with manager.connection('dev_test') as db:
+                rows = db.test.all()
+
+        If the configuration has a priority section, the block first waits for one of its
+        slots; priority (priority.HIGH, NORMAL or LOW) defaults to LEVEL_PRIORITIES.  Only
+        these blocks, transaction() and batch writer flushes are gated: get_connection()
+        and for_key() handles have no end to release a slot at, so they bypass the gate.
+        '''
+
+        with self._admitted(config, security_level, priority):
+            db = self._new_connection(config, security_level)
+            try:
+                yield db
+            finally:
+                db.session.remove()
+
+    @contextlib.contextmanager
+    def transaction(self, config=None, security_level=ConnectionLevel.UPDATE, priority=None):
+        '''Yield a SQLSoup connection; commit if the block succeeds, roll back if it raises.
+
+        Either way the connection goes back to the pool when the block exits.  priority is
+        as for connection().
+        '''
+
+        with self._admitted(config, security_level, priority):
+            db = self._new_connection(config, security_level)
+            try:
+                yield db
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def run_transaction(self, work, config=None, security_level=ConnectionLevel.UPDATE,
+                        attempts=retry.RETRY_ATTEMPTS, base_delay=retry.RETRY_BASE_DELAY,
+                        max_delay=retry.RETRY_MAX_DELAY):
+        '''Run work(db) in a transaction (see transaction()) and return its result, replaying
+        the whole unit of work when it fails on a deadlock or serialization failure.
+
+        Up to attempts runs are made, with jittered exponential backoff between them.  work
+        may run more than once, so it should only touch the database.  Replays are counted
+        per call site in retry_stats.
+
+            def debit(db):
+                db.accounts.get(1).balance -= 10
+
+            manager.run_transaction(debit, 'production')
+        '''
+
+        caller = sys._getframe(1)
+        call_site = '{0}:{1} in {2}'.format(caller.f_code.co_filename, caller.f_lineno, caller.f_code.co_name)
+        dialect = self._engine_for(config, security_level).dialect.name
+
+        for attempt in range(attempts):
+            try:
+                with self.transaction(config, security_level) as db:
+                    return work(db)
+            except sqlalchemy.exc.DBAPIError as exc:
+                if not dialects.is_retryable(dialect, exc):
+                    raise
+                if attempt == attempts - 1:
+                    self.retry_stats.gave_up(call_site)
+                    logger.error('Transaction at {0} failed after {1} attempts: {2}'.format(call_site, attempts, exc))
+                    raise
+                self.retry_stats.retried(call_site)
+                delay = retry.backoff(attempt, base_delay, max_delay)
+                logger.info('Replaying transaction at {0} in {1:.3f}s: {2}'.format(call_site, delay, exc))
+                time.sleep(delay)
+
+    def release(self):
+        '''Return the connections held by this thread's get_connection/for_key handles to the pool.
+
+        Those handles share this Manager's thread-local session; removing it rolls back
+        anything uncommitted and checks its connections in.  Call this at the end of each
+        request (see sqlconmanager.web for WSGI and Flask hooks).
+        '''
+
+        self._session.remove()
+
+    def _maintained_engines(self):
+        return [(engine, self._budgets.get(config_name))
+                for engine, (config_name, _) in list(self._engine_keys.items())]
+
+    def start_maintenance(self, **settings):
+        '''Start a background thread that maintains the pools of all engines of this Manager.
+
+        Each pass closes connections idle longer than idle_timeout (keeping min_idle),
+        reconnects idle connections due for pool_recycle within recycle_margin seconds,
+        and opens connections until min_idle are idle, so requests do not pay for
+        reconnects.  settings: interval, min_idle, idle_timeout, recycle_margin.
+        '''
+
+        if self.maintainer is None:
+            self.maintainer = PoolMaintainer(self._maintained_engines, **settings)
+        self.maintainer.start()
+        return self.maintainer
+
+    def stop_maintenance(self):
+        '''Stop the pool maintenance thread, if running.'''
+
+        if self.maintainer is not None:
+            self.maintainer.stop()
+            self.maintainer = None
+
+    def mirror(self, config=None):
+        '''SQLSoup over the local SQLite mirror of a configuration's mirrored_tables.
+
+        The mirror is loaded on first use (see start_mirrors) and refreshed in the
+        background; reads never touch the remote database.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        with self._engine_lock:
+            table_mirror = self._mirrors.get(config)
+        if table_mirror is not None:
+            return table_mirror.soup()
+
+        self._load_configs()
+        conn_config = self.db_configs['database_configurations'].get(config) or {}
+        spec = dict(conn_config.get('mirrored_tables') or {})
+        tables = spec.pop('tables', None)
+        if not tables:
+            raise ManagerConnectionException('No mirrored_tables for {0}'.format(config))
+        if 'refresh' in spec:
+            spec['interval'] = spec.pop('refresh')
+
+        try:
+            table_mirror = TableMirror(self._engine_for(config, ConnectionLevel.READ_ONLY), tables, **spec)
+        except TypeError as exc:
+            raise ManagerConnectionException('Invalid mirrored_tables for {0}: {1}'.format(config, exc))
+        table_mirror.load()
+        with self._engine_lock:
+            if config in self._mirrors:
+                table_mirror.close()
+                table_mirror = self._mirrors[config]
+            else:
+                self._mirrors[config] = table_mirror
+                table_mirror.start()
+        logger.info('Mirrored {0} tables of {1}'.format(len(tables), config))
+        return table_mirror.soup()
+
+    def start_mirrors(self):
+        '''Load the mirrors of every configuration declaring mirrored_tables (call at startup).'''
+
+        self._load_configs()
+        for config, conn_config in self.db_configs['database_configurations'].items():
+            if (conn_config or {}).get('mirrored_tables'):
+                self.mirror(config)
+
+    def close(self):
+        '''Release this thread's sessions and dispose of every engine (closing pooled connections).'''
+
+        self.stop_maintenance()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        for table_mirror in self._mirrors.values():
+            table_mirror.close()
+        self._mirrors = {}
+        for selector in self._host_selectors.values():
+            selector.stop()
+        self._host_selectors = {}
+        self.release()
+        engines = set(self.db_engines.values())
+        if self.db_engine is not None:
+            engines.add(self.db_engine)
+        for engine in engines:
+            engine.dispose()
+
+        self.db_engines = {}
+        self._shard_connections = {}
+        self.unset_engine()
+        with self._reflection_lock:
+            self._engine_metadata = {}
+        with self._entity_lock:
+            self._entity_connections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _track_session_writes(self, session_registry):
+        '''Invalidate entity cache entries for objects updated or deleted through session_registry.'''
+
+        manager_ref = weakref.ref(self)
+
+        def after_flush(session, flush_context):
+            manager = manager_ref()
+            if manager is None:
+                return
+            keys = session.info.setdefault('sqlconmanager_entities', set())
+            for instance in list(session.dirty) + list(session.deleted):
+                mapper = sqlalchemy.orm.object_mapper(instance)
+                engine_key = manager._engine_keys.get(session.get_bind(mapper))
+                if engine_key is not None:
+                    keys.add((engine_key[0], mapper.local_table.name,
+                              tuple(mapper.primary_key_from_instance(instance))))
+            for key in keys:
+                manager.entity_cache.invalidate(key)
+
+        def after_commit(session):
+            # Invalidate again: a reader may have cached the old row between flush and commit.
+            manager = manager_ref()
+            for key in session.info.pop('sqlconmanager_entities', ()):
+                if manager is not None:
+                    manager.entity_cache.invalidate(key)
+
+        def after_rollback(session):
+            session.info.pop('sqlconmanager_entities', None)
+
+        sqlalchemy.event.listen(session_registry, 'after_flush', after_flush)
+        sqlalchemy.event.listen(session_registry, 'after_commit', after_commit)
+        sqlalchemy.event.listen(session_registry, 'after_rollback', after_rollback)
+
+    def _invalidate_entity(self, config, table, key):
+        '''Invalidate the entity of table identified by key (a column -> value dict).
+
+        Keys on other columns than the primary key (a unique column, say) cannot be
+        mapped to a cache entry, so they drop every entry of the table.
+        '''
+
+        primary_key = self._primary_key_of(config, table)
+        if primary_key is not None and set(key) == set(primary_key):
+            self.entity_cache.invalidate((config, table, tuple(key[name] for name in primary_key)))
+        else:
+            self.entity_cache.invalidate_table(config, table)
+
+    def _primary_key_of(self, config, table):
+        '''Primary key column names of table if it has been reflected for config, else None.'''
+
+        with self._reflection_lock:
+            for engine, (config_name, _) in list(self._engine_keys.items()):
+                metadata = self._engine_metadata.get(id(engine))
+                if config_name == config and metadata is not None and table in metadata.tables:
+                    return [column.name for column in metadata.tables[table].primary_key.columns]
+        return None
+
+    def pipeline(self, config=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Return a Pipeline: statements queued with add() and sent together by execute().
+
+        See pipeline.Pipeline; MySQL configurations need the multi_statements engine
+        option for the single round trip.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        engine = self._engine_for(config, security_level)
+        return Pipeline(engine, dialects.multi_statements(self.db_configs['database_configurations'][config]))
+
+    def get_entity(self, table, pk, config=None, security_level=ConnectionLevel.READ_ONLY):
+        '''Return db.<table>.get(pk), served from the entity cache when possible.
+
+        The returned object is detached and shared between callers: treat it as read-only.
+        Updates and deletes made through this Manager's SQLSoup handles and batch writers
+        invalidate the entry; other writes (raw SQL, other processes) show up once the
+        entry expires (see EntityCache ttl).  Missing rows are not cached.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        key = (config, table, pk if isinstance(pk, tuple) else (pk,))
+        entity = self.entity_cache.get(key)
+        if entity is not MISSING:
+            return entity
+
+        generation = self.entity_cache.generation(key)
+        db_key = (config, security_level)
+        with self._entity_lock:
+            db = self._entity_connections.get(db_key)
+            if db is None:
+                db = self._entity_connections[db_key] = self._new_connection(config, security_level)
+            mapped = db.entity(table)
+
+        try:
+            entity = mapped.get(pk)
+            if entity is not None:
+                db.session.expunge(entity)
+        finally:
+            db.session.remove()
+
+        if entity is not None:
+            self.entity_cache.put(key, entity, generation)
+        return entity
+
+    def _metadata_for(self, engine):
+        '''The MetaData shared by everything this Manager reflects through engine.'''
+
+        with self._reflection_lock:
+            metadata = self._engine_metadata.get(id(engine))
+            if metadata is None:
+                metadata = self._engine_metadata[id(engine)] = sqlalchemy.MetaData()
+            return metadata
+
+    def _reflect_table(self, engine, table):
+        '''Return the reflected Table for engine, reflecting it on first use.
+
+        Reflection runs outside the lock, into a private MetaData, so several tables can
+        be reflected at once; the first copy to finish is the one shared.
+        '''
+
+        metadata = self._metadata_for(engine)
+        with self._reflection_lock:
+            if table in metadata.tables:
+                return metadata.tables[table]
+
+        reflected = sqlalchemy.Table(table, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+        with self._reflection_lock:
+            if table not in metadata.tables:
+                reflection.bind_table(reflected.tometadata(metadata), engine)
+            return metadata.tables[table]
+
+    def _soup(self, engine, **soup_args):
+        '''SQLSoup handle on engine that maps tables from the shared, reflect-once MetaData.
+
+        Unless soup_args names another session, the handle uses this Manager's thread-local one.
+        '''
+
+        soup_args.setdefault('session', self._session)
+        return reflection.SharedSoup(engine, self._metadata_for(engine), lambda table: self._reflect_table(engine, table),
+                                     **soup_args)
+
+    def preload_tables(self, config=None, security_level=ConnectionLevel.READ_ONLY, tables=None,
+                       workers=reflection.PRELOAD_WORKERS):
+        '''Reflect tables (default: the configuration's preload_tables) over workers pooled
+        connections at once, so that SQLSoup handles map them without catalog queries.
+
+        Returns the tables that could not be reflected.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        engine = self._engine_for(config, security_level)
+        if tables is None:
+            tables = self.db_configs['database_configurations'][config].get('preload_tables') or []
+        return reflection.preload(lambda table: self._reflect_table(engine, table), tables, workers)
+
+    def warm_up(self, security_levels=(ConnectionLevel.READ_ONLY,), workers=reflection.PRELOAD_WORKERS):
+        '''Preload the preload_tables of every configuration declaring some, for each of
+        security_levels.  Call at startup.  Returns {(config, level): failed tables}.
+        '''
+
+        self._load_configs()
+        failed = {}
+        for config, conn_config in self.db_configs['database_configurations'].items():
+            if not (conn_config or {}).get('preload_tables'):
+                continue
+            for security_level in security_levels:
+                failed_tables = self.preload_tables(config, security_level, workers=workers)
+                if failed_tables:
+                    failed[(config, security_level)] = failed_tables
+        return failed
+
+    def refresh_schema(self, config=None, tables=None):
+        '''Forget the reflected tables (default: all of them) of a configuration, so that the
+        next use reflects them again.  Call after DDL changes.
+
+        Handles that already mapped a table keep using the old mapping; get a new one.
+        Cached entities of the tables are dropped too.  Returns the names of the tables
+        forgotten.
+        '''
+
+        if not config:
+            config = self.database_configuration
+
+        forgotten = set()
+        with self._reflection_lock:
+            for engine, (config_name, _) in list(self._engine_keys.items()):
+                metadata = self._engine_metadata.get(id(engine))
+                if config_name != config or metadata is None:
+                    continue
+                for name in list(metadata.tables) if tables is None else tables:
+                    if name in metadata.tables:
+                        metadata.remove(metadata.tables[name])
+                        forgotten.add(name)
+        with self._entity_lock:
+            self._entity_connections = {}
+        self._shard_connections = {}
+        for name in forgotten:
+            self.entity_cache.invalidate_table(config, name)
+        return sorted(forgotten)
+
+    def fetch_by_keys(self, table, column, keys, config=None, security_level=ConnectionLevel.READ_ONLY,
+                      chunk_size=bulk.IN_CHUNK_SIZE, workers=bulk.FETCH_WORKERS,
+                      temp_table_threshold=bulk.TEMP_TABLE_THRESHOLD):
+        '''Yield the rows of table whose column value is in keys (rows come in no particular order).
+
+        Keys are split into IN lists of chunk_size (capped by the dialect's bind parameter
+        limit) fetched in parallel over up to workers pooled connections.  Above
+        temp_table_threshold keys, they are bulk-loaded into a temporary table and joined
+        instead, falling back to IN lists if the temporary table cannot be created.
+        '''
+
+        engine = self._engine_for(config, security_level)
+        table = self._reflect_table(engine, table)
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        chunk_size = min(chunk_size, dialects.max_bind_params(engine.dialect.name))
+
+        if len(keys) > temp_table_threshold:
+            started = False
+            try:
+                for row in bulk.fetch_joined(engine, table, column, keys, chunk_size):
+                    started = True
+                    yield row
+                return
+            except sqlalchemy.exc.DBAPIError as exc:
+                if started:
+                    raise
+                logger.warning('Temporary key table failed, falling back to IN lists: {0}'.format(exc))
+
+        for row in bulk.fetch_chunked(engine, table, column, keys, chunk_size, workers):
+            yield row
+
+    def iter_pages(self, table, order_by_key, page_size=bulk.PAGE_SIZE, where=None, config=None,
+                   security_level=ConnectionLevel.READ_ONLY, prefetch=True):
+        '''Yield the rows of table (matching where, a SQL string or clause) in pages of
+        page_size rows, ordered by order_by_key (a column name or list of them).
+
+        Pages are read with keyset (seek) pagination rather than OFFSET, so every page
+        costs about the same; with prefetch the next page is read while the caller
+        processes the current one.  See bulk.iter_pages.
+        '''
+
+        engine = self._engine_for(config, security_level)
+        if isinstance(where, sqlalchemy.util.string_types):
+            where = sqlalchemy.text(where)
+        return bulk.iter_pages(engine, self._reflect_table(engine, table), order_by_key, page_size, where, prefetch)
+
+    def copy_table(self, src_config, dst_config, table, where=None, workers=transfer.COPY_WORKERS,
+                   batch_size=transfer.COPY_BATCH_SIZE, checkpoint=None):
+        '''Copy the rows of table (matching where, a SQL string or clause) from src_config to
+        dst_config; returns the number of rows copied.
+
+        The table must exist in dst_config and have a single-column primary key.  Integer
+        keys are split into ranges copied in parallel over workers connections; each range
+        is read with a streamed query and inserted batch_size rows per transaction.  With
+        checkpoint (a file path), progress is saved after every batch, and calling again
+        with the same arguments resumes an interrupted copy; rows of the destination that
+        fall in unfinished ranges are deleted before they are copied again.
+        '''
+
+        src_engine = self._engine_for(src_config, ConnectionLevel.READ_ONLY)
+        dst_engine = self._engine_for(dst_config, ConnectionLevel.UPDATE)
+        if isinstance(where, sqlalchemy.util.string_types):
+            where = sqlalchemy.text(where)
+        signature = [src_config, dst_config, table, None if where is None else str(where)]
+        if any(isinstance(engine.pool, sqlalchemy.pool.StaticPool) for engine in (src_engine, dst_engine)):
+            workers = 1  # one shared connection: parallel transactions on it would interleave
+
+        return transfer.copy_table(src_engine, self._reflect_table(src_engine, table),
+                                   dst_engine, self._reflect_table(dst_engine, table), where, workers, batch_size,
+                                   transfer.Checkpoint(checkpoint, signature))
+
+
+#######################################################################################
+# Command line: latency probes, pool benchmarks and pool metrics
+
+LEVELS = {'ro': ConnectionLevel.READ_ONLY, 'update': ConnectionLevel.UPDATE, 'admin': ConnectionLevel.ADMIN}
+
+
+def _percentile(ordered, fraction):
+    '''Nearest-rank percentile of an ordered list.'''
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _millis(seconds):
+    return '{0:.2f}ms'.format(seconds * 1000)
+
+
+def _ping(mgr, args):
+    configs = args.configs or sorted(mgr.get_connection_config_list())
+    failed = False
+    for config in configs:
+        try:
+            engine = mgr._engine_for(config, LEVELS[args.level])
+            start = time.time()
+            connection = engine.connect()
+            connect = time.time() - start
+            try:
+                round_trips = []
+                for _ in range(args.count):
+                    start = time.time()
+                    connection.execute("select 1").scalar()
+                    round_trips.append(time.time() - start)
+            finally:
+                connection.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            print('{0}:{1} FAILED {2}'.format(config, args.level, exc))
+            failed = True
+            continue
+        round_trips.sort()
+        print('{0}:{1} connect {2} round trip min {3} median {4} max {5}'.format(
+            config, args.level, _millis(connect), _millis(round_trips[0]), _millis(_percentile(round_trips, 0.5)),
+            _millis(round_trips[-1])))
+    return 1 if failed else 0
+
+
+def _bench(mgr, args):
+    engine = mgr._engine_for(args.config, LEVELS[args.level])
+    latencies = [[] for _ in range(args.threads)]
+    errors = []
+
+    def worker(samples):
+        try:
+            for _ in range(args.queries):
+                start = time.time()
+                connection = engine.connect()
+                try:
+                    connection.execute(args.query).fetchall()
+                finally:
+                    connection.close()
+                samples.append(time.time() - start)
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+    threads = [threading.Thread(target=worker, args=(samples,)) for samples in latencies]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    samples = sorted(sample for thread_samples in latencies for sample in thread_samples)
+    if not samples:
+        print('{0}:{1} FAILED {2}'.format(args.config, args.level, errors[0] if errors else 'no queries'))
+        return 1
+    print('{0}:{1} {2} threads, {3} queries in {4:.2f}s: {5:.0f} queries/s'.format(
+        args.config, args.level, args.threads, len(samples), elapsed, len(samples) / elapsed))
+    print('checkout+query p50 {0} p90 {1} p99 {2} max {3}'.format(
+        _millis(_percentile(samples, 0.5)), _millis(_percentile(samples, 0.9)), _millis(_percentile(samples, 0.99)),
+        _millis(samples[-1])))
+    print('pool: {0}'.format(engine.pool.status()))
+    if errors:
+        print('{0} threads failed, first error: {1}'.format(len(errors), errors[0]))
+    return 1 if errors else 0
+
+
+def _stats(mgr, args):
+    configs = args.configs or sorted(mgr.get_connection_config_list())
+    for config in configs:
+        engine = mgr._engine_for(config, LEVELS[args.level])
+        connections = [engine.connect() for _ in range(args.connections)]
+        for connection in connections:
+            connection.close()
+    for entry in mgr.pool_stats():
+        print(' '.join('{0}={1}'.format(key, value) for key, value in entry.items()))
+    return 0
+
+
+def main(argv=None):
+    '''connection_manager.py [--config dbconfig.yaml] {ping,bench,stats} ...'''
+
+    parser = argparse.ArgumentParser(description='Probe and benchmark sqlconmanager database configurations.')
+    parser.add_argument('--config', dest='config_file', type=argparse.FileType('r'), help='dbconfig.yaml to use (default: the packaged one)')
+    parser.add_argument('--level', choices=sorted(LEVELS), default='ro', help='security level (default: ro)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ping = subparsers.add_parser('ping', help='connect and round-trip latency per configuration')
+    ping.add_argument('configs', nargs='*', help='configurations (default: all)')
+    ping.add_argument('--count', type=int, default=10, help='round trips to time (default: 10)')
+    ping.set_defaults(run=_ping)
+
+    bench = subparsers.add_parser('bench', help='throughput and latency of checkout+query from N threads')
+    bench.add_argument('config')
+    bench.add_argument('--threads', type=int, default=POOL_SIZE, help='default: {0}'.format(POOL_SIZE))
+    bench.add_argument('--queries', type=int, default=1000, help='queries per thread (default: 1000)')
+    bench.add_argument('--query', default='select 1', help='statement to run (default: select 1)')
+    bench.set_defaults(run=_bench)
+
+    stats = subparsers.add_parser('stats', help='pool metrics after opening some connections')
+    stats.add_argument('configs', nargs='*', help='configurations (default: all)')
+    stats.add_argument('--connections', type=int, default=1, help='connections to open first (default: 1)')
+    stats.set_defaults(run=_stats)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        with Manager(args.config_file) as mgr:
+            # stdout carries the command's output; SQLAlchemy's echo would print there too.
+            mgr.pool_echo = False
+            return args.run(mgr, args)
+    finally:
+        if args.config_file is not None:
+            args.config_file.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
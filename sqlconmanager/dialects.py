@@ -0,0 +1,332 @@
+'''Dialect-specific SQL and connection setup used by the connection manager.'''
+
+import copy
+import logging
+
+import sqlalchemy
+import sqlalchemy.pool
+
+logger = logging.getLogger(__name__)
+
+MYSQL = "mysql"
+POSTGRESQL = "postgresql"
+SQLITE = "sqlite"
+
+SQLITE_MEMORY = ":memory:"
+
+# Engine option profiles, overridable per configuration with an engine_options mapping
+# in dbconfig.yaml.  Keys other than the ones below are passed to create_engine as-is
+# (e.g. server_side_cursors: true to stream every result on MySQL/Postgres):
+#   read_only_isolation  isolation level of READ_ONLY engines (AUTOCOMMIT skips BEGIN/ROLLBACK)
+#   compress             MySQL protocol compression (mysqlclient), worthwhile on slow links
+#   pragmas              SQLite PRAGMAs run on each new connection
+#   poolclass            name of a sqlalchemy.pool class
+#   multi_statements     MySQL multi-statement queries, used by Manager.pipeline(); off by
+#                        default since it also lets injected SQL stack statements
+ENGINE_PROFILES = {
+    MYSQL: {
+        'read_only_isolation': 'AUTOCOMMIT',
+        'compress': False,
+        'multi_statements': False,
+    },
+    POSTGRESQL: {
+        'read_only_isolation': 'AUTOCOMMIT',
+    },
+    SQLITE: {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'foreign_keys': 'ON',
+        },
+    },
+}
+
+# CLIENT_MULTI_STATEMENTS connect flag (mysqlclient and pymysql).
+_MYSQL_MULTI_STATEMENTS = 1 << 16
+
+# Options only understood by QueuePool.
+_QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+# Session statement timeout, in milliseconds.  MySQL's max_execution_time only applies to SELECT.
+_STATEMENT_TIMEOUT_SQL = {
+    MYSQL: "SET SESSION max_execution_time = {0}",
+    POSTGRESQL: "SET statement_timeout = {0}",
+}
+
+_BACKEND_ID_SQL = {
+    MYSQL: "SELECT CONNECTION_ID()",
+    POSTGRESQL: "SELECT pg_backend_pid()",
+}
+
+_CANCEL_SQL = {
+    MYSQL: "KILL QUERY {0}",
+    POSTGRESQL: "SELECT pg_cancel_backend({0})",
+}
+
+# Errors after which a transaction can simply be replayed: deadlocks, lock wait timeouts
+# and serialization failures (MySQL error numbers, Postgres SQLSTATEs, SQLite messages).
+_RETRYABLE_ERRORS = {
+    MYSQL: (1213, 1205),
+    POSTGRESQL: ('40001', '40P01'),
+    SQLITE: ('database is locked',),
+}
+
+# Errors meaning the server could not be reached or dropped the connection: MySQL client
+# and server error numbers, Postgres SQLSTATE prefixes (class 08 and shutdowns), SQLite
+# messages.  Postgres client-side connect failures carry no SQLSTATE at all.
+_DISCONNECT_ERRORS = {
+    MYSQL: (1040, 1053, 2002, 2003, 2005, 2006, 2013, 2055),
+    POSTGRESQL: ('08', '57P01', '57P02', '57P03'),
+    SQLITE: ('unable to open database file', 'disk I/O error'),
+}
+
+# Dialects whose ascending order puts NULLs first.
+_NULLS_SORT_FIRST = (MYSQL, SQLITE)
+
+# Most bind parameters a single statement may carry (SQLite before 3.32 allows 999).
+MAX_BIND_PARAMS = {
+    MYSQL: 65535,
+    POSTGRESQL: 32767,
+    SQLITE: 999,
+}
+
+
+class BackendId(int):
+    '''Server-side connection id that also remembers the (host, port) it belongs to, for
+    configurations with several hosts (see failover.py): ids are only unique per server.'''
+
+    def __new__(cls, backend_id, host=None):
+        value = super(BackendId, cls).__new__(cls, backend_id)
+        value.host = host
+        return value
+
+
+def dialect_name(dbtype):
+    '''Dialect of a dbconfig.yaml dbtype ("mysql+pymysql" -> "mysql").'''
+
+    return dbtype.split('+')[0]
+
+
+def max_bind_params(dialect):
+    '''Most bind parameters one statement may carry on dialect.'''
+
+    return MAX_BIND_PARAMS.get(dialect, 999)
+
+
+def connection_url(conn_config, username=None, password=None):
+    '''SQLAlchemy URL for a dbconfig.yaml configuration (dbname is the file path for SQLite).'''
+
+    dbtype = conn_config['dbtype']
+    if dialect_name(dbtype) == SQLITE:
+        dbname = conn_config.get('dbname') or SQLITE_MEMORY
+        return '{0}://'.format(dbtype) if dbname == SQLITE_MEMORY else '{0}:///{1}'.format(dbtype, dbname)
+
+    return '{0}://{1}:{2}@{3}:{4}/{5}'.format(dbtype, username,
+                                             password,
+                                             conn_config["host"],
+                                             conn_config["port"],
+                                             conn_config["dbname"])
+
+
+def multi_statements(conn_config):
+    '''True if a configuration's connections accept several statements per query.'''
+
+    if dialect_name(conn_config['dbtype']) != MYSQL:
+        return False
+    options = dict(ENGINE_PROFILES[MYSQL], **(conn_config.get('engine_options') or {}))
+    return bool(options.get('multi_statements'))
+
+
+def engine_options(conn_config, read_only, pool_options):
+    '''create_engine arguments for a configuration, from its dialect profile and engine_options.
+
+    pool_options holds the Manager's pool_size/max_overflow/pool_recycle defaults.
+    Returns (create_engine keyword arguments, SQLite pragmas); raises ValueError for
+    an unknown poolclass.
+    '''
+
+    dialect = dialect_name(conn_config['dbtype'])
+    options = copy.deepcopy(ENGINE_PROFILES.get(dialect, {}))
+    options.update(pool_options)
+    options.update(copy.deepcopy(conn_config.get('engine_options') or {}))
+
+    pragmas = options.pop('pragmas', None) or {}
+    read_only_isolation = options.pop('read_only_isolation', None)
+    if read_only and read_only_isolation:
+        options.setdefault('isolation_level', read_only_isolation)
+    if options.pop('compress', False):
+        options.setdefault('connect_args', {})['compress'] = True
+    if options.pop('multi_statements', False):
+        connect_args = options.setdefault('connect_args', {})
+        connect_args['client_flag'] = connect_args.get('client_flag', 0) | _MYSQL_MULTI_STATEMENTS
+
+    if isinstance(options.get('poolclass'), str):
+        poolclass = getattr(sqlalchemy.pool, options['poolclass'], None)
+        if not (isinstance(poolclass, type) and issubclass(poolclass, sqlalchemy.pool.Pool)):
+            raise ValueError('Unknown poolclass {0}'.format(options['poolclass']))
+        options['poolclass'] = poolclass
+
+    if dialect == SQLITE:
+        pragmas = dict(pragmas)
+        if read_only:
+            pragmas['query_only'] = 'ON'
+        options.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+        if (conn_config.get('dbname') or SQLITE_MEMORY) == SQLITE_MEMORY:
+            # One shared connection, so every thread sees the same in-memory database.
+            options.setdefault('poolclass', sqlalchemy.pool.StaticPool)
+        else:
+            options.setdefault('poolclass', sqlalchemy.pool.QueuePool)
+
+    if not issubclass(options.get('poolclass', sqlalchemy.pool.QueuePool), sqlalchemy.pool.QueuePool):
+        for option in _QUEUE_POOL_OPTIONS:
+            options.pop(option, None)
+
+    return options, pragmas
+
+
+def unpooled(conn_config, options):
+    '''Turn create_engine options into non-pooling ones (a :memory: SQLite database keeps its single connection).'''
+
+    options = dict(options)
+    if dialect_name(conn_config['dbtype']) == SQLITE and (conn_config.get('dbname') or SQLITE_MEMORY) == SQLITE_MEMORY:
+        return options
+
+    options['poolclass'] = sqlalchemy.pool.NullPool
+    for option in _QUEUE_POOL_OPTIONS:
+        options.pop(option, None)
+    return options
+
+
+def nulls_first(dialect, column):
+    '''Ascending order on column with NULLs first, as a plain column where the dialect
+    already sorts that way, so that an index on it can serve the sort.'''
+
+    if dialect in _NULLS_SORT_FIRST:
+        return column
+    return column.nullsfirst()
+
+
+def streaming(connection):
+    '''Return connection, ready for a streamed (server-side cursor) result read in a transaction.
+
+    psycopg2 refuses named cursors in autocommit mode, so on an AUTOCOMMIT engine (the
+    read_only_isolation default) the connection is switched to the server's default
+    isolation level until it goes back to the pool.
+    '''
+
+    dialect = connection.dialect
+    if dialect.isolation_level != 'AUTOCOMMIT':
+        return connection
+    level = dialect.default_isolation_level
+    if level in (None, 'AUTOCOMMIT'):
+        level = 'READ COMMITTED'
+    return connection.execution_options(isolation_level=level)
+
+
+def session_setup_statements(dialect, statement_timeout=None, pragmas=None):
+    '''Statements that set up a new connection: pragmas, then the statement timeout (seconds).'''
+
+    statements = ['PRAGMA {0} = {1}'.format(name, value) for name, value in sorted((pragmas or {}).items())]
+    if statement_timeout and dialect in _STATEMENT_TIMEOUT_SQL:
+        statements.append(_STATEMENT_TIMEOUT_SQL[dialect].format(int(statement_timeout * 1000)))
+    return statements
+
+
+def install_session_setup(engine, dialect, statement_timeout=None, pragmas=None):
+    '''Set up each new DBAPI connection of engine: pragmas and statement timeout.
+
+    These are session settings, so they are applied once per connection rather than at
+    every checkout; a connection needing none costs no extra round trip.
+    '''
+
+    statements = session_setup_statements(dialect, statement_timeout, pragmas)
+    if not statements:
+        return
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        # Keep the settings out of the first transaction, which the pool may roll back.
+        dbapi_connection.commit()
+
+    sqlalchemy.event.listen(engine, 'connect', on_connect)
+
+
+def backend_id(dialect, connection):
+    '''Server-side id of connection (a SQLAlchemy Connection), or None for dialects without one.
+
+    It is looked up on the connection itself the first time it is asked for, and kept in
+    the info of the pooled connection for later checkouts.
+    '''
+
+    info = connection.connection.info
+    if 'backend_id' not in info:
+        sql = _BACKEND_ID_SQL.get(dialect)
+        info['backend_id'] = None if sql is None else connection.execute(sqlalchemy.text(sql)).scalar()
+    return info['backend_id']
+
+
+def cancel_statement(engine, dialect, backend_id, host=None):
+    '''Cancel the statement running on backend_id, using a connection from outside the pool.
+
+    The pool may be exhausted exactly when a cancel is needed, so a direct DBAPI
+    connection is opened for the cancel and closed afterwards.  It goes to host (a
+    (host, port) pair) if given, otherwise to the host of engine's URL.
+    '''
+
+    if dialect not in _CANCEL_SQL:
+        raise NotImplementedError('Statement cancellation is not supported for {0}'.format(dialect))
+
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    if host is not None:
+        cparams = dict(cparams, host=host[0], port=host[1])
+    dbapi_connection = engine.dialect.connect(*cargs, **cparams)
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(_CANCEL_SQL[dialect].format(int(backend_id)))
+        cursor.close()
+        dbapi_connection.commit()
+    finally:
+        dbapi_connection.close()
+
+
+def is_retryable(dialect, exc):
+    '''True if exc (a sqlalchemy DBAPIError) is a deadlock or serialization failure on dialect.'''
+
+    errors = _RETRYABLE_ERRORS.get(dialect, ())
+    orig = getattr(exc, 'orig', None)
+    if orig is None:
+        return False
+    if dialect == MYSQL:
+        return bool(orig.args) and orig.args[0] in errors
+    if dialect == POSTGRESQL:
+        return getattr(orig, 'pgcode', None) in errors
+    return any(error in str(orig) for error in errors)
+
+
+def is_disconnect(dialect, exc):
+    '''True if exc (a sqlalchemy DBAPIError) means the database could not be reached.
+
+    Statement errors that drivers also report as OperationalError (MySQL's unknown
+    column, say) are not disconnects.
+    '''
+
+    if exc.connection_invalidated:
+        return True
+    errors = _DISCONNECT_ERRORS.get(dialect, ())
+    orig = getattr(exc, 'orig', None)
+    if orig is None:
+        return False
+    if dialect == MYSQL:
+        return bool(orig.args) and orig.args[0] in errors
+    if dialect == POSTGRESQL:
+        pgcode = getattr(orig, 'pgcode', None)
+        if pgcode is None:
+            return isinstance(exc, sqlalchemy.exc.OperationalError)
+        return any(pgcode.startswith(error) for error in errors)
+    return any(error in str(orig) for error in errors)
@@ -0,0 +1,5 @@
+'''Exceptions raised by the connection manager.'''
+
+
+class ManagerConnectionException(Exception):
+    pass
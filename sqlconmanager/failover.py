@@ -0,0 +1,161 @@
+'''Multi-host configurations: connect to the fastest healthy host, fail over on connect errors.'''
+
+import logging
+import socket
+import threading
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+
+logger = logging.getLogger(__name__)
+
+PROBE_INTERVAL = 10  # seconds between background latency probes
+PROBE_TIMEOUT = 2  # seconds a probe waits for a TCP connect
+LATENCY_MARGIN = 0.005  # seconds another host must beat the preferred one by before it takes over
+LATENCY_SMOOTHING = 0.3  # weight of the newest probe in a host's latency average
+
+
+def parse_hosts(hosts, default_port):
+    '''(host, port) pairs from a dbconfig.yaml hosts list of "host:port" strings or host/port mappings.'''
+
+    parsed = []
+    for entry in hosts:
+        if isinstance(entry, dict):
+            parsed.append((entry['host'], int(entry.get('port', default_port))))
+        else:
+            host, _, port = str(entry).partition(':')
+            parsed.append((host, int(port or default_port)))
+    return parsed
+
+
+class HostSelector(object):
+    '''Choose among the hosts of a configuration: healthy hosts first, fastest first.
+
+    A background thread measures the TCP connect time of every host each probe_interval
+    seconds.  A host is marked down when a probe or a real connect to it fails, and up
+    again when a probe succeeds, so the pool fails back without a restart.  The preferred
+    host only changes when it is down or another host is faster by more than
+    latency_margin, so noisy measurements do not make connections churn.
+    '''
+
+    def __init__(self, name, hosts, probe_interval=PROBE_INTERVAL, probe_timeout=PROBE_TIMEOUT,
+                 latency_margin=LATENCY_MARGIN):
+        self.name = name
+        self.hosts = list(hosts)
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.latency_margin = latency_margin
+        self.latency = {}
+        self.down = set()
+        self.preferred = self.hosts[0]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ranked(self):
+        '''Hosts in the order to try them: the preferred one, the other healthy ones by latency, then the down ones.'''
+
+        with self._lock:
+            return sorted(self.hosts, key=lambda host: (host in self.down, host != self.preferred,
+                                                        self.latency.get(host, float('inf'))))
+
+    def mark_down(self, host):
+        with self._lock:
+            if host not in self.down:
+                logger.warning('{0}: host {1}:{2} is down'.format(self.name, host[0], host[1]))
+            self.down.add(host)
+            self._choose()
+
+    def mark_up(self, host, latency=None):
+        '''Record a successful probe (with its latency) or connect to host.'''
+
+        with self._lock:
+            if latency is not None:
+                previous = self.latency.get(host)
+                self.latency[host] = latency if previous is None else \
+                    LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * previous
+            if host in self.down:
+                logger.info('{0}: host {1}:{2} is back up'.format(self.name, host[0], host[1]))
+                self.down.discard(host)
+            self._choose()
+
+    def _choose(self):
+        healthy = [host for host in self.hosts if host not in self.down]
+        if not healthy:
+            return
+        fastest = min(healthy, key=lambda host: self.latency.get(host, float('inf')))
+        current = self.latency.get(self.preferred, float('inf'))
+        if self.preferred in self.down or self.latency.get(fastest, float('inf')) + self.latency_margin < current:
+            if fastest != self.preferred:
+                logger.info('{0}: preferring host {1}:{2}'.format(self.name, fastest[0], fastest[1]))
+            self.preferred = fastest
+
+    def probe(self):
+        '''Measure the connect latency of every host once.'''
+
+        for host in self.hosts:
+            start = time.time()
+            try:
+                socket.create_connection(host, self.probe_timeout).close()
+            except (socket.error, socket.timeout):
+                self.mark_down(host)
+            else:
+                self.mark_up(host, time.time() - start)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sqlconmanager-host-probe')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.probe()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('{0}: host probe failed: {1}'.format(self.name, exc))
+            if self._stop.wait(self.probe_interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def attach(self, engine):
+        '''Make engine connect to the best host, trying the others in turn on connect errors.
+
+        Idle connections to a host that is down are replaced at checkout; connections to a
+        host that is no longer preferred are closed at checkin, so the pool drifts back.
+        '''
+
+        def on_do_connect(dialect, connection_record, cargs, cparams):
+            error = None
+            for host in self.ranked():
+                params = dict(cparams, host=host[0], port=host[1])
+                try:
+                    dbapi_connection = dialect.connect(*cargs, **params)
+                except dialect.dbapi.Error as exc:
+                    logger.warning('{0}: connect to {1}:{2} failed: {3}'.format(self.name, host[0], host[1], exc))
+                    self.mark_down(host)
+                    error = exc
+                    continue
+                self.mark_up(host)
+                connection_record.info['host'] = host
+                return dbapi_connection
+            raise error
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            if connection_record.info.get('host') in self.down:
+                raise sqlalchemy.exc.DisconnectionError('Host {0}:{1} is down'.format(*connection_record.info['host']))
+
+        def on_checkin(dbapi_connection, connection_record):
+            host = connection_record.info.get('host')
+            if dbapi_connection is not None and host is not None and host != self.preferred:
+                connection_record.invalidate()
+
+        sqlalchemy.event.listen(engine, 'do_connect', on_do_connect)
+        sqlalchemy.event.listen(engine, 'checkout', on_checkout)
+        sqlalchemy.event.listen(engine, 'checkin', on_checkin)
@@ -0,0 +1,127 @@
+'''Cooperative (gevent) mode: a greenlet-fair connection pool and green database drivers.
+
+gevent is optional; it is only imported by Managers created with cooperative=True.
+'''
+
+import logging
+
+import sqlalchemy
+import sqlalchemy.pool
+
+from sqlalchemy.util import queue as sqla_queue
+
+from sqlconmanager import dialects
+from sqlconmanager.exceptions import ManagerConnectionException
+
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.queue
+    import gevent.socket
+except ImportError:
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+_patched_drivers = set()
+
+
+def require_gevent():
+    if gevent is None:
+        raise ManagerConnectionException('Cooperative mode needs gevent (pip install sqlconmanager[gevent])')
+    if not gevent.monkey.is_module_patched('socket'):
+        logger.warning('Cooperative mode without gevent.monkey.patch_all(): pure-Python drivers will block the hub')
+
+
+class GreenQueue(object):
+    '''The queue QueuePool keeps idle connections in, built on gevent's queue.
+
+    Waiting greenlets yield to the hub and are served in arrival order, instead of
+    polling a thread Condition.
+    '''
+
+    def __init__(self, maxsize=0, use_lifo=False):
+        self.maxsize = maxsize
+        self.use_lifo = use_lifo
+        self._queue = (gevent.queue.LifoQueue if use_lifo else gevent.queue.Queue)(maxsize if maxsize > 0 else None)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def empty(self):
+        return self._queue.empty()
+
+    def full(self):
+        return self._queue.full()
+
+    def put(self, item, block=True, timeout=None):
+        try:
+            self._queue.put(item, block, timeout)
+        except gevent.queue.Full:
+            raise sqla_queue.Full()
+
+    def get(self, block=True, timeout=None):
+        try:
+            return self._queue.get(block, timeout)
+        except gevent.queue.Empty:
+            raise sqla_queue.Empty()
+
+
+class GreenQueuePool(sqlalchemy.pool.QueuePool):
+    '''QueuePool whose checkouts wait cooperatively (and fairly) when the pool is exhausted.'''
+
+    def __init__(self, creator, pool_size=5, **kw):
+        super(GreenQueuePool, self).__init__(creator, pool_size=pool_size, **kw)
+        self._pool = GreenQueue(pool_size, kw.get('use_lifo', False))
+
+
+def _psycopg2_wait(connection, timeout=None):
+    '''psycopg2 wait callback that yields to the gevent hub while the server works.'''
+
+    import psycopg2
+    from psycopg2 import extensions
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            gevent.socket.wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            gevent.socket.wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('Bad result from poll: {0!r}'.format(state))
+
+
+def green_driver(dbtype):
+    '''Make the DBAPI driver of dbtype yield to the hub while waiting on the server (once per driver).'''
+
+    if dbtype in _patched_drivers:
+        return
+    _patched_drivers.add(dbtype)
+
+    dialect = dialects.dialect_name(dbtype)
+    if dialect == dialects.POSTGRESQL and dbtype in (dialects.POSTGRESQL, 'postgresql+psycopg2'):
+        from psycopg2 import extensions
+        extensions.set_wait_callback(_psycopg2_wait)
+    elif dialect == dialects.MYSQL and dbtype != 'mysql+pymysql':
+        logger.warning('{0} blocks the gevent hub during queries; use dbtype mysql+pymysql'.format(dbtype))
+
+
+def engine_options(options):
+    '''Turn create_engine options into cooperative ones: QueuePools become GreenQueuePools.'''
+
+    options = dict(options)
+    if options.get('poolclass', sqlalchemy.pool.QueuePool) is sqlalchemy.pool.QueuePool:
+        options['poolclass'] = GreenQueuePool
+    return options
+
+
+def validate(connection, timeout):
+    '''Run "select 1" on connection, giving up (ManagerConnectionException) after timeout seconds.
+
+    With a green driver the query yields to other greenlets while it waits.
+    '''
+
+    with gevent.Timeout(timeout, ManagerConnectionException('Validation timed out after {0}s'.format(timeout))):
+        connection.execute("select 1")
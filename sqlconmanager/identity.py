@@ -0,0 +1,54 @@
+'''Bounded session identity maps for long-running SQLSoup handles.'''
+
+import collections
+import logging
+
+import sqlalchemy
+import sqlalchemy.orm
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_MAP_SIZE = 10000  # objects kept per session
+
+
+class IdentityMapLimit(object):
+    '''Keep the identity maps of a session registry's sessions from growing without bound.
+
+    Sessions keep at most max_objects loaded objects: past that, the least recently
+    loaded unmodified object is expunged (it stays usable, detached, for as long as the
+    caller holds it).  With expunge_on_commit every commit empties the identity map.
+    Both settings may be changed at any time.
+    '''
+
+    def __init__(self, max_objects=IDENTITY_MAP_SIZE, expunge_on_commit=False):
+        self.max_objects = max_objects
+        self.expunge_on_commit = expunge_on_commit
+        self.expunged = 0
+
+    def attach(self, session_registry):
+        sqlalchemy.event.listen(session_registry, 'loaded_as_persistent', self._loaded)
+        sqlalchemy.event.listen(session_registry, 'after_commit', self._committed)
+
+    def _loaded(self, session, instance):
+        if not self.max_objects:
+            return
+
+        loaded = session.info.get('sqlconmanager_loaded')
+        if loaded is None:
+            loaded = session.info['sqlconmanager_loaded'] = collections.OrderedDict()
+        key = sqlalchemy.inspect(instance).key
+        loaded.pop(key, None)
+        loaded[key] = True
+
+        while len(loaded) > self.max_objects:
+            oldest = session.identity_map.get(loaded.popitem(last=False)[0])
+            if oldest is None or sqlalchemy.inspect(oldest).modified or oldest in session.deleted:
+                continue
+            session.expunge(oldest)
+            self.expunged += 1
+
+    def _committed(self, session):
+        if self.expunge_on_commit:
+            self.expunged += len(session.identity_map)
+            session.expunge_all()
+            session.info.pop('sqlconmanager_loaded', None)
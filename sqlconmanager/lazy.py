@@ -0,0 +1,59 @@
+'''Lazily constructed SQLSoup handles.'''
+
+import sqlalchemy
+import sqlsoup
+
+
+class LazySoup(object):
+    '''Stand-in for sqlsoup.SQLSoup that builds the real one on first use.
+
+    Nothing is checked out until then.  prepare, if given, is called with the new
+    SQLSoup on first use and returns the one to use (the Manager validates the
+    connection there, rebuilding the engine if needed).
+
+    execute() needs neither: it runs the statement straight in the session the SQLSoup
+    uses (soup_args' session, or SQLSoup's default one), so commit() and rollback() still
+    cover raw statements.  A dead pooled connection then surfaces as the statement's
+    error, and SQLAlchemy's disconnect handling recycles the pool for the next call.
+    '''
+
+    def __init__(self, engine, factory=sqlsoup.SQLSoup, prepare=None, **soup_args):
+        self._engine = engine
+        self._factory = factory
+        self._prepare = prepare
+        self._soup_args = soup_args
+        self._soup = None
+
+    @property
+    def soup(self):
+        '''The underlying SQLSoup, built on first access.'''
+
+        if self._soup is None:
+            soup = self._factory(self._engine, **self._soup_args)
+            if self._prepare is not None:
+                soup = self._prepare(soup)
+            self._soup = soup
+        return self._soup
+
+    @property
+    def bind(self):
+        return self._engine if self._soup is None else self._soup.bind
+
+    engine = bind
+
+    def execute(self, stmt, **params):
+        # SQLSoup.execute hands params to Session.execute as keywords, which it rejects.
+        if isinstance(stmt, sqlalchemy.util.string_types):
+            stmt = sqlalchemy.text(stmt)
+        if self._soup is not None:
+            return self._soup.session.execute(stmt, params, bind=self._soup.bind)
+        session = self._soup_args.get('session', sqlsoup.Session)
+        return session.execute(stmt, params, bind=self._engine)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.soup, attr)
+
+    def __repr__(self):
+        return 'LazySoup({0!r})'.format(self.bind)
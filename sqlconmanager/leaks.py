@@ -0,0 +1,118 @@
+'''Connection leak detection: track pool checkouts and report long-held connections.'''
+
+import collections
+import logging
+import os
+import random
+import time
+import traceback
+
+import sqlalchemy
+import sqlsoup
+
+import sqlconmanager
+
+logger = logging.getLogger(__name__)
+
+LEAK_THRESHOLD = 60  # seconds
+LEAK_SAMPLE_RATE = 0.01
+LEAK_STACK_DEPTH = 30
+
+# Frames from SQLAlchemy, SQLSoup and this package's modules are not call sites - the
+# caller is whoever called into them.
+_LIBRARY_PATHS = (os.path.dirname(sqlalchemy.__file__) + os.sep, os.path.splitext(sqlsoup.__file__)[0])
+_PACKAGE_DIR = os.path.dirname(sqlconmanager.__file__)
+
+Checkout = collections.namedtuple('Checkout', 'engine since stack')
+
+
+def is_library_file(filename):
+    '''True for the source files of SQLAlchemy, SQLSoup and this package's modules.'''
+
+    return filename.startswith(_LIBRARY_PATHS) or os.path.dirname(filename) == _PACKAGE_DIR
+
+
+def _call_site(stack):
+    '''Innermost frame of stack outside SQLAlchemy/SQLSoup/this package, as "file:line in function".'''
+
+    for filename, lineno, function, _ in reversed(stack):
+        if not is_library_file(filename):
+            return '{0}:{1} in {2}'.format(filename, lineno, function)
+    if stack:
+        filename, lineno, function, _ = stack[-1]
+        return '{0}:{1} in {2}'.format(filename, lineno, function)
+    return None
+
+
+class LeakDetector(object):
+    '''Record pool checkouts and report connections held longer than threshold seconds.
+
+    Every checkout costs a clock read and a dictionary update; the stack is only captured
+    for a sample_rate fraction of checkouts, so call sites are reported for a sample of
+    the leaks while the overhead stays low.
+    '''
+
+    def __init__(self, threshold=LEAK_THRESHOLD, sample_rate=LEAK_SAMPLE_RATE, stack_depth=LEAK_STACK_DEPTH):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.stack_depth = stack_depth
+        self._checkouts = {}
+        self._returned_late = collections.Counter()
+
+    def attach(self, engine, name):
+        '''Start tracking the pool of engine; name labels it in reports.'''
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            stack = None
+            if self.sample_rate and random.random() < self.sample_rate:
+                stack = traceback.extract_stack(limit=self.stack_depth)
+            self._checkouts[id(connection_record)] = Checkout(name, time.time(), stack)
+
+        def on_checkin(dbapi_connection, connection_record):
+            checkout = self._checkouts.pop(id(connection_record), None)
+            if checkout is None:
+                return
+            held = time.time() - checkout.since
+            if held > self.threshold:
+                site = _call_site(checkout.stack) if checkout.stack else None
+                self._returned_late[site] += 1
+                logger.warning('Connection to {0} held {1:.1f}s (checked out at {2})'.format(
+                    checkout.engine, held, site or 'unsampled call site'))
+
+        sqlalchemy.event.listen(engine, 'checkout', on_checkout)
+        sqlalchemy.event.listen(engine, 'checkin', on_checkin)
+
+    def leaks(self):
+        '''Return (engine, held seconds, call site or None) for connections held beyond the threshold.'''
+
+        now = time.time()
+        held = []
+        for checkout in list(self._checkouts.values()):
+            if now - checkout.since > self.threshold:
+                site = _call_site(checkout.stack) if checkout.stack else None
+                held.append((checkout.engine, now - checkout.since, site))
+        return sorted(held, key=lambda leak: -leak[1])
+
+    def top_call_sites(self, limit=10):
+        '''Return the (call site, count) pairs that most often held connections too long.
+
+        Counts cover connections still held and those returned late; only sampled
+        checkouts have a call site.
+        '''
+
+        sites = collections.Counter(self._returned_late)
+        for _, _, site in self.leaks():
+            sites[site] += 1
+        sites.pop(None, None)
+        return sites.most_common(limit)
+
+    def report(self, limit=10):
+        '''Log the current leaks and top leaking call sites; return the leak list.'''
+
+        leaks = self.leaks()
+        checked_out = len(self._checkouts)
+        logger.warning('{0} of {1} checked out connections held longer than {2}s'.format(
+            len(leaks), checked_out, self.threshold))
+        for site, count in self.top_call_sites(limit):
+            logger.warning('  {0} leaked connection(s) from {1}'.format(count, site))
+        return leaks
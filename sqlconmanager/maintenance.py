@@ -0,0 +1,138 @@
+'''Background pool maintenance: reap idle connections, refresh old ones, keep some warm.
+
+This works on the idle connections of SQLAlchemy's QueuePool (its internal queue of
+connection records), one record at a time, so requests only ever miss the connection
+currently being looked at.
+'''
+
+import logging
+import threading
+import time
+import weakref
+
+import sqlalchemy
+import sqlalchemy.pool
+
+from sqlalchemy.util import queue as sqla_queue
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_INTERVAL = 30  # seconds between passes
+MIN_IDLE_CONNECTIONS = 2
+IDLE_TIMEOUT = 300  # seconds an idle connection beyond MIN_IDLE_CONNECTIONS is kept
+RECYCLE_MARGIN = 120  # refresh connections this many seconds before pool_recycle would
+
+
+class PoolMaintainer(object):
+    '''Daemon thread maintaining the pools of the engines returned by get_engines().
+
+    get_engines returns (engine, budget) pairs; budget is a ConnectionBudget or None.
+    When another process is waiting on the budget, idle connections beyond the budget's
+    reserve are closed straight away.
+    '''
+
+    def __init__(self, get_engines, interval=MAINTENANCE_INTERVAL, min_idle=MIN_IDLE_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT, recycle_margin=RECYCLE_MARGIN):
+        self.get_engines = get_engines
+        self.interval = interval
+        self.min_idle = min_idle
+        self.idle_timeout = idle_timeout
+        self.recycle_margin = recycle_margin
+        self._tracked = weakref.WeakKeyDictionary()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sqlconmanager-pool-maintenance')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        '''Run one maintenance pass over every engine.'''
+
+        for engine, budget in self.get_engines():
+            if not isinstance(engine.pool, sqlalchemy.pool.QueuePool):
+                continue
+            self._track(engine)
+            try:
+                self._maintain(engine.pool, budget)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Pool maintenance failed for {0!r}: {1}'.format(engine.url, exc))
+
+    def _track(self, engine):
+        if engine in self._tracked:
+            return
+
+        def on_checkin(dbapi_connection, connection_record):
+            connection_record.info['checkin_time'] = time.time()
+
+        sqlalchemy.event.listen(engine, 'checkin', on_checkin)
+        self._tracked[engine] = True
+
+    def _maintain(self, pool, budget):
+        now = time.time()
+        min_idle = min(self.min_idle, pool.size())
+        idle_timeout = self.idle_timeout
+        if budget is not None and budget.in_demand():
+            min_idle = min(min_idle, budget.reserve)
+            idle_timeout = 0
+
+        kept = reaped = refreshed = 0
+        for _ in range(pool._pool.qsize()):
+            try:
+                record = pool._pool.get(False)
+            except sqla_queue.Empty:
+                break
+
+            idle = now - record.info.get('checkin_time', record.starttime)
+            if kept >= min_idle and idle > idle_timeout:
+                record.close()
+                pool._dec_overflow()
+                reaped += 1
+                continue
+
+            if record.connection is None or (pool._recycle > -1 and
+                                             now - record.starttime > pool._recycle - self.recycle_margin):
+                record.close()
+                try:
+                    record.get_connection()
+                    refreshed += 1
+                except Exception:
+                    pool._dec_overflow()
+                    raise
+            kept += 1
+            self._return(pool, record)
+
+        warmed = 0
+        while pool.checkedin() < min_idle and pool._inc_overflow():
+            try:
+                record = pool._create_connection()
+            except Exception:
+                pool._dec_overflow()
+                raise
+            self._return(pool, record)
+            warmed += 1
+
+        if reaped or refreshed or warmed:
+            logger.debug('Pool maintenance: reaped {0}, refreshed {1}, warmed {2}; {3}'.format(
+                reaped, refreshed, warmed, pool.status()))
+
+    @staticmethod
+    def _return(pool, record):
+        try:
+            pool._pool.put(record, False)
+        except sqla_queue.Full:
+            record.close()
+            pool._dec_overflow()
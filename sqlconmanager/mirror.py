@@ -0,0 +1,172 @@
+'''Local SQLite mirror of small, rarely changing reference tables.'''
+
+import logging
+import os
+import tempfile
+import threading
+
+import sqlalchemy
+import sqlalchemy.orm
+import sqlsoup
+
+from sqlconmanager import dialects
+
+logger = logging.getLogger(__name__)
+
+MIRROR_REFRESH_INTERVAL = 300  # seconds
+MIRROR_FULL_REFRESH_EVERY = 12  # incremental refreshes between full reloads (which pick up deletes)
+
+
+def _local_type(column_type):
+    '''Generic equivalent of a (possibly dialect-specific) column type, usable on SQLite.'''
+
+    affinity = getattr(column_type, '_type_affinity', None)
+    try:
+        return affinity() if affinity is not None else sqlalchemy.types.NullType()
+    except TypeError:
+        return sqlalchemy.types.NullType()
+
+
+class _LatestQuery(sqlalchemy.orm.Query):
+    '''Query that overwrites objects already in the session with the rows it reads, so
+    objects loaded before a refresh do not hide the refreshed rows.'''
+
+    def __iter__(self):
+        return super(_LatestQuery, self.populate_existing()).__iter__()
+
+    def get(self, ident):
+        return super(_LatestQuery, self.populate_existing()).get(ident)
+
+
+class TableMirror(object):
+    '''Copy of some tables of a source database in a local SQLite file, refreshed in the background.
+
+    tables maps table name -> spec; a spec may name a version_column (a timestamp or
+    version number bumped on every change), in which case refreshes only fetch rows at
+    or above the last version seen.  Tables without one are reloaded in full every
+    refresh; all tables are reloaded every full_refresh_every refreshes, which is when
+    deleted rows disappear.
+
+    The default file is a temporary one in WAL mode with mmap, so readers are never
+    blocked by a refresh and read from memory; it is removed by close().
+    '''
+
+    def __init__(self, source_engine, tables, path=None, interval=MIRROR_REFRESH_INTERVAL,
+                 full_refresh_every=MIRROR_FULL_REFRESH_EVERY):
+        self.source_engine = source_engine
+        self.tables = dict((name, spec or {}) for name, spec in tables.items())
+        self.interval = interval
+        self.full_refresh_every = full_refresh_every
+
+        self._temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='sqlconmanager-mirror-', suffix='.db')
+            os.close(handle)
+        self.path = path
+
+        conn_config = {'dbtype': dialects.SQLITE, 'dbname': path}
+        options, pragmas = dialects.engine_options(conn_config, False, {})
+        self.engine = sqlalchemy.create_engine(dialects.connection_url(conn_config), **options)
+        dialects.install_session_setup(self.engine, dialects.SQLITE, pragmas=pragmas)
+
+        self._source_tables = {}
+        self._local_tables = {}
+        self._versions = {}
+        self._refreshes = 0
+        self._soup = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        '''Create the local tables and copy every mirrored table in full.'''
+
+        source_metadata = sqlalchemy.MetaData()
+        local_metadata = sqlalchemy.MetaData()
+        for name in self.tables:
+            source = sqlalchemy.Table(name, source_metadata, autoload=True, autoload_with=self.source_engine)
+            local = sqlalchemy.Table(name, local_metadata,
+                                     *[sqlalchemy.Column(column.name, _local_type(column.type),
+                                                         primary_key=column.primary_key)
+                                       for column in source.columns])
+            self._source_tables[name] = source
+            self._local_tables[name] = local
+        local_metadata.drop_all(self.engine)
+        local_metadata.create_all(self.engine)
+
+        for name in self.tables:
+            self._refresh_table(name, full=True)
+
+    def refresh(self):
+        '''Bring every mirrored table up to date.'''
+
+        self._refreshes += 1
+        full = self.full_refresh_every and self._refreshes % self.full_refresh_every == 0
+        for name in self.tables:
+            try:
+                self._refresh_table(name, full)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Refreshing mirror of {0} failed: {1}'.format(name, exc))
+
+    def _refresh_table(self, name, full):
+        source = self._source_tables[name]
+        local = self._local_tables[name]
+        version_column = self.tables[name].get('version_column')
+        last_version = self._versions.get(name)
+        incremental = version_column is not None and last_version is not None and not full
+
+        query = sqlalchemy.select([source])
+        if incremental:
+            query = query.where(source.c[version_column] >= last_version)
+
+        with self.source_engine.connect() as source_connection:
+            rows = [dict(row) for row in source_connection.execute(query)]
+
+        with self.engine.begin() as connection:
+            if not incremental:
+                connection.execute(local.delete())
+            if rows:
+                connection.execute(local.insert().prefix_with('OR REPLACE'), rows)
+
+        if version_column is not None and rows:
+            newest = max(row[version_column] for row in rows if row[version_column] is not None)
+            self._versions[name] = max(newest, last_version) if incremental else newest
+        logger.debug('Mirror of {0}: {1} {2} rows'.format(name, 'upserted' if incremental else 'loaded', len(rows)))
+
+    def soup(self):
+        '''SQLSoup over the mirror.
+
+        Its session autocommits and its queries repopulate the objects they return
+        (including ones a caller still holds), so every query sees the latest refresh.
+        '''
+
+        if self._soup is None:
+            session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=self.engine, autocommit=True,
+                                                                                 query_cls=_LatestQuery))
+            soup = sqlsoup.SQLSoup(self.engine, session=session)
+            for name in self.tables:
+                soup.entity(name)
+            self._soup = soup
+        return self._soup
+
+    def start(self):
+        '''Refresh every interval seconds in a daemon thread.'''
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sqlconmanager-mirror')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.engine.dispose()
+        if self._temporary:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
@@ -0,0 +1,120 @@
+'''Statement pipelines: send several statements in as few round trips as the dialect allows.'''
+
+import copy
+import logging
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline(object):
+    '''Statements queued with add() and run together by execute(), on one connection and
+    in one transaction.
+
+    With multi_statements (MySQL configurations with the multi_statements engine option,
+    see dialects.py) the whole pipeline is one multi-statement query: one round trip.
+    Elsewhere the statements run one after the other on a single checked-out
+    connection, which still saves the checkouts.
+
+        pipeline = manager.pipeline('dev_test')
+        pipeline.add("SELECT name FROM users WHERE id = :id", id=1)
+        pipeline.add("SELECT count(*) AS n FROM orders")
+        users, counts = pipeline.execute()
+
+    execute() returns one entry per statement, in order: a list of rows (as dictionaries)
+    for statements that return rows, the row count for the others.
+    '''
+
+    def __init__(self, engine, multi_statements=False):
+        self.engine = engine
+        self.multi_statements = multi_statements
+        self._statements = []
+
+    def add(self, statement, **params):
+        '''Queue statement (SQL text with :name parameters, or a SQLAlchemy construct).'''
+
+        if isinstance(statement, sqlalchemy.util.string_types):
+            statement = sqlalchemy.text(statement)
+        self._statements.append((statement, params))
+        return self
+
+    def __len__(self):
+        return len(self._statements)
+
+    def execute(self):
+        '''Run the queued statements; return their results in order.'''
+
+        statements, self._statements = self._statements, []
+        if not statements:
+            return []
+        if self.multi_statements:
+            return self._execute_multi(statements)
+
+        results = []
+        with self.engine.begin() as connection:
+            for statement, params in statements:
+                result = connection.execute(statement, **params)
+                results.append([dict(row) for row in result] if result.returns_rows else result.rowcount)
+        return results
+
+    def _positional_dialect(self):
+        '''The engine's dialect, made positional (%s) if its driver takes pyformat (%(name)s).
+
+        Statements are bound positionally so each keeps its own parameters: merged into
+        one dictionary, names used by several statements would overwrite each other.
+        MySQL drivers accept both styles.
+        '''
+
+        dialect = self.engine.dialect
+        if dialect.positional:
+            return dialect
+        if dialect.paramstyle != 'pyformat':
+            raise NotImplementedError('Pipelines cannot bind {0} parameters in one query'.format(dialect.paramstyle))
+        dialect = copy.copy(dialect)
+        dialect.paramstyle = 'format'
+        dialect.positional = True
+        return dialect
+
+    def _render(self, statements):
+        '''(SQL of the multi-statement query, its positional parameters) for statements.'''
+
+        dialect = self._positional_dialect()
+        sql = []
+        params = []
+        for statement, statement_params in statements:
+            compiled = statement.compile(dialect=dialect)
+            values = compiled.construct_params(statement_params)
+            processors = compiled._bind_processors  # pylint: disable=protected-access
+            for name in compiled.positiontup:
+                value = values[name]
+                params.append(processors[name](value) if name in processors else value)
+            sql.append(compiled.string)
+        return ';\n'.join(sql), params
+
+    def _execute_multi(self, statements):
+        sql, params = self._render(statements)
+
+        results = []
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql, params)
+                while True:
+                    if cursor.description is not None:
+                        names = [column[0] for column in cursor.description]
+                        results.append([dict(zip(names, row)) for row in cursor.fetchall()])
+                    else:
+                        results.append(cursor.rowcount)
+                    if not cursor.nextset():
+                        break
+            finally:
+                cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return results
@@ -0,0 +1,92 @@
+'''Priority-aware admission to a configuration's connections.'''
+
+import itertools
+import logging
+import threading
+import time
+
+from sqlconmanager.exceptions import ManagerConnectionException
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+PRIORITY_AGING = 5.0  # seconds of waiting that raise a waiter one priority class
+
+
+class _Waiter(object):
+    __slots__ = ('priority', 'since', 'seq')
+
+    def __init__(self, priority, seq):
+        self.priority = priority
+        self.since = time.time()
+        self.seq = seq
+
+
+class PriorityGate(object):
+    '''Admit at most capacity concurrent users, serving waiters by priority (HIGH first).
+
+    reserved maps a priority to slots kept free for it and the classes above it: a LOW
+    request is only admitted while more slots are free than HIGH and NORMAL reserve.
+    Waiters move up one class in the queue per aging seconds waited, so low-priority
+    work still gets through under sustained load; aging only changes the order, the
+    reservations always apply to a waiter's own priority.  Within a class, waiters are
+    served in arrival order.  A free slot goes to the first waiter in that order whose
+    priority may take it.
+    '''
+
+    def __init__(self, name, capacity, reserved=None, aging=PRIORITY_AGING, timeout=None):
+        self.name = name
+        self.capacity = capacity
+        self.reserved = dict(reserved or {})
+        self.aging = aging
+        self.timeout = timeout
+        self.in_use = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _effective(self, waiter, now):
+        if not self.aging:
+            return waiter.priority
+        return max(HIGH, waiter.priority - int((now - waiter.since) / self.aging))
+
+    def _reserve_above(self, priority):
+        '''Slots that a request of priority must leave free.'''
+
+        return sum(slots for reserved_priority, slots in self.reserved.items() if reserved_priority < priority)
+
+    def acquire(self, priority=NORMAL, timeout=None):
+        '''Wait for a slot; raises ManagerConnectionException after timeout seconds.'''
+
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            waiter = _Waiter(priority, next(self._seq))
+            self._waiters.append(waiter)
+            deadline = None if timeout is None else waiter.since + timeout
+            try:
+                while True:
+                    now = time.time()
+                    free = self.capacity - self.in_use
+                    eligible = [other for other in self._waiters if free > self._reserve_above(other.priority)]
+                    if eligible and min(eligible, key=lambda other: (self._effective(other, now), other.seq)) is waiter:
+                        self.in_use += 1
+                        return
+                    if deadline is not None and now >= deadline:
+                        raise ManagerConnectionException('No {0} connection slot for priority {1} within {2}s'.format(
+                            self.name, priority, timeout))
+                    # Wake up at least when the next aging step could change the order.
+                    wait = self.aging or None
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(waiter)
+                self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify_all()
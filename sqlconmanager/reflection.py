@@ -0,0 +1,108 @@
+'''Schema reflection shared by the SQLSoup handles of an engine, and parallel preloading.'''
+
+import logging
+import threading
+import weakref
+
+import sqlalchemy
+import sqlsoup
+from sqlalchemy.sql import util as sql_util
+
+from concurrent import futures
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_WORKERS = 4
+
+# Table.info key of the (weakly referenced) engine a shared Table was reflected from.
+ENGINE_INFO = 'sqlconmanager.engine'
+
+
+def bind_table(table, engine):
+    '''Record on table the engine SharedSession binds it to.
+
+    The shared MetaData is unbound, and the engine is only referenced weakly, so the
+    reflected schema never keeps a dropped engine (and its pool) alive.
+    '''
+
+    table.info[ENGINE_INFO] = weakref.ref(engine)
+    return table
+
+
+def _engine_of(tables):
+    for table in tables:
+        engine_ref = getattr(table, 'info', {}).get(ENGINE_INFO)
+        engine = engine_ref() if engine_ref is not None else None
+        if engine is not None:
+            return engine
+    return None
+
+
+class SharedSession(sqlalchemy.orm.Session):
+    '''Session that binds tables marked by bind_table() to their engine.'''
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = None
+        if mapper is not None:
+            engine = _engine_of(sqlalchemy.inspect(mapper).tables)
+        if engine is None and clause is not None:
+            engine = _engine_of(sql_util.find_tables(clause, include_crud=True))
+        if engine is not None:
+            return engine
+        return super(SharedSession, self).get_bind(mapper, clause)
+
+
+class SharedSoup(sqlsoup.SQLSoup):
+    '''SQLSoup whose tables come from reflect(name), which returns the Table shared by
+    every handle of the engine, so each table is only reflected once per engine.
+
+    The mapped classes are still per handle: they are tied to the handle's session,
+    which must be a SharedSession as the MetaData is not bound to engine.  Tables are
+    mapped under a lock, so threads sharing a handle can map the same table at once.
+    '''
+
+    def __init__(self, engine, metadata, reflect, **soup_args):
+        super(SharedSoup, self).__init__(metadata, **soup_args)
+        self._engine = engine
+        self._reflect = reflect
+        self._map_lock = threading.Lock()
+
+    @property
+    def bind(self):
+        return self._engine
+
+    engine = bind
+
+    def entity(self, attr, schema=None):
+        if attr in self._cache:
+            return self._cache[attr]
+        table = None if schema is not None else self._reflect(attr)
+        with self._map_lock:
+            if attr in self._cache:
+                return self._cache[attr]
+            if table is None:
+                mapped = super(SharedSoup, self).entity(attr, schema)
+                bind_table(sqlalchemy.inspect(mapped).local_table, self._engine)
+                return mapped
+            return self.map_to(attr, selectable=table)
+
+
+def preload(reflect, tables, workers=PRELOAD_WORKERS):
+    '''Call reflect(table) for every table, over workers threads (and pooled connections).
+
+    Returns the names of the tables that could not be reflected; the errors are logged.
+    '''
+
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = dict((executor.submit(reflect, table), table) for table in tables)
+        failed = []
+        for future in futures.as_completed(pending):
+            try:
+                future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Reflecting {0} failed: {1}'.format(pending[future], exc))
+                failed.append(pending[future])
+    finally:
+        executor.shutdown(wait=True)
+    return failed
@@ -0,0 +1,42 @@
+'''Replaying transactions that failed on a deadlock or serialization failure.'''
+
+import collections
+import random
+import threading
+
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.05  # seconds; the backoff cap doubles with every attempt
+RETRY_MAX_DELAY = 2.0
+
+
+def backoff(attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    '''Seconds to wait before replaying after the attempt-th failure (0-based), with full jitter.
+
+    Random delays spread out the transactions that collided, so they do not deadlock again.
+    '''
+
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class RetryStats(object):
+    '''Count replays, and transactions that ran out of attempts, per call site.'''
+
+    def __init__(self):
+        self.retries = collections.Counter()
+        self.exhausted = collections.Counter()
+        self._lock = threading.Lock()
+
+    def retried(self, call_site):
+        with self._lock:
+            self.retries[call_site] += 1
+
+    def gave_up(self, call_site):
+        with self._lock:
+            self.exhausted[call_site] += 1
+
+    def report(self, limit=10):
+        '''(call site, retries, exhausted) of the call sites retrying most.'''
+
+        with self._lock:
+            return [(call_site, count, self.exhausted[call_site])
+                    for call_site, count in self.retries.most_common(limit)]
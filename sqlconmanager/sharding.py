@@ -0,0 +1,111 @@
+'''Shard maps: route a shard key to one of the configured databases.'''
+
+import bisect
+import logging
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+HASH = "hash"
+RANGE = "range"
+
+DEFAULT_BUCKETS = 256
+
+
+def _key_bytes(key):
+    '''Stable byte representation of a shard key (hash() is salted per process).'''
+
+    if isinstance(key, bytes):
+        return key
+    return u'{0}'.format(key).encode('utf-8')
+
+
+class ShardMap(object):
+    '''Map of shard keys to database configuration names.
+
+    A hash map spreads keys over a fixed number of buckets, each assigned to a
+    configuration; a range map assigns each configuration the keys from its lower
+    bound up to the next one.  Shards are moved by swapping in a new routing table,
+    so lookups never take a lock.
+    '''
+
+    def __init__(self, name, strategy, shards=None, buckets=DEFAULT_BUCKETS, assignments=None, ranges=None):
+        self.name = name
+        self.strategy = strategy
+        self._lock = threading.Lock()
+
+        if strategy == HASH:
+            if not shards:
+                raise ValueError('Hash shard map {0} has no shards'.format(name))
+            if buckets < len(shards):
+                raise ValueError('Hash shard map {0} has fewer buckets than shards'.format(name))
+            table = [shards[bucket % len(shards)] for bucket in range(buckets)]
+            for bucket, config_name in (assignments or {}).items():
+                table[self._bucket_index(bucket, buckets)] = config_name
+            self._buckets = table
+        elif strategy == RANGE:
+            if not ranges:
+                raise ValueError('Range shard map {0} has no ranges'.format(name))
+            ranges = sorted((lower, config_name) for lower, config_name in ranges)
+            self._routes = ([lower for lower, _ in ranges], [config_name for _, config_name in ranges])
+        else:
+            raise ValueError('Unknown shard strategy {0} for shard map {1}'.format(strategy, name))
+
+    def _bucket_index(self, bucket, buckets):
+        index = int(bucket)
+        if not 0 <= index < buckets:
+            raise IndexError('Bucket {0} out of range 0..{1} in shard map {2}'.format(bucket, buckets - 1, self.name))
+        return index
+
+    @classmethod
+    def from_config(cls, name, spec):
+        '''Build a shard map from its dbconfig.yaml entry.'''
+
+        return cls(name, spec.get('strategy', HASH),
+                   shards=spec.get('shards'),
+                   buckets=spec.get('buckets', DEFAULT_BUCKETS),
+                   assignments=spec.get('assignments'),
+                   ranges=spec.get('ranges'))
+
+    def lookup(self, key):
+        '''Return the configuration name holding key.'''
+
+        if self.strategy == HASH:
+            buckets = self._buckets
+            return buckets[(zlib.crc32(_key_bytes(key)) & 0xffffffff) % len(buckets)]
+
+        lowers, config_names = self._routes
+        index = bisect.bisect_right(lowers, key) - 1
+        if index < 0:
+            raise KeyError('Key {0} is below the first range of shard map {1}'.format(key, self.name))
+        return config_names[index]
+
+    def config_names(self):
+        '''Return the set of configuration names this map routes to.'''
+
+        if self.strategy == HASH:
+            return set(self._buckets)
+        return set(self._routes[1])
+
+    def move(self, shard, config_name):
+        '''Point a shard (a bucket number, or a range lower bound) at another configuration.
+
+        Data migration is up to the caller; the new routing takes effect for the next lookup.
+        '''
+
+        with self._lock:
+            if self.strategy == HASH:
+                table = list(self._buckets)
+                table[self._bucket_index(shard, len(table))] = config_name
+                self._buckets = table
+            else:
+                lowers, config_names = self._routes
+                index = bisect.bisect_left(lowers, shard)
+                if index == len(lowers) or lowers[index] != shard:
+                    raise KeyError('No range starting at {0} in shard map {1}'.format(shard, self.name))
+                config_names = list(config_names)
+                config_names[index] = config_name
+                self._routes = (lowers, config_names)
+
+        logger.info('Shard map {0}: moved shard {1} to {2}'.format(self.name, shard, config_name))
@@ -0,0 +1,239 @@
+'''Durable local write spool that absorbs writes while a database is unreachable.'''
+
+import logging
+import pickle
+import sqlite3
+import threading
+
+import sqlalchemy
+
+from sqlconmanager import batching
+from sqlconmanager import dialects
+
+logger = logging.getLogger(__name__)
+
+SPOOL_BATCH_SIZE = 500  # writes drained per transaction
+SPOOL_PROBE_INTERVAL = 5  # seconds between reconnect attempts while a database is down
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS spool (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    config TEXT NOT NULL,
+    level TEXT NOT NULL,
+    op TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failed (
+    seq INTEGER PRIMARY KEY,
+    config TEXT NOT NULL,
+    level TEXT NOT NULL,
+    op TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    error TEXT
+);
+'''
+
+
+def is_outage(engine, exc):
+    '''True if exc means the database of engine could not be reached (as opposed to a bad statement).'''
+
+    return isinstance(exc, sqlalchemy.exc.DBAPIError) and dialects.is_disconnect(engine.dialect.name, exc)
+
+
+class WriteSpool(object):
+    '''Write inserts/updates straight through while the database is up; spool them to a
+    local SQLite file (WAL, synchronous=FULL) while it is down.
+
+    A background thread (unless background is False) drains the spool in seq order, in
+    batches of batch_size writes per transaction, once the database answers again.
+    While a configuration has spooled writes, new writes for it are spooled too, so
+    writes keep their order: a configuration only stops spooling once its last batch has
+    been committed.  Direct writes take no lock; drains of a configuration are serialized
+    by its own lock, which writers never wait for.  Only connection failures (see
+    dialects.is_disconnect) count as outages.  Delivery is
+    at-least-once: a crash between the remote commit and the local delete replays that
+    batch.  Writes the database rejects (constraint violations and the like) are moved to
+    the `failed` table rather than blocking the spool.
+
+    engine_for(config, level) returns the engine for a configuration; on_commit(config,
+    writes) is called after writes have been committed remotely.
+    '''
+
+    def __init__(self, path, engine_for, batch_size=SPOOL_BATCH_SIZE, probe_interval=SPOOL_PROBE_INTERVAL,
+                 on_commit=None, background=True):
+        self.path = path
+        self.engine_for = engine_for
+        self.batch_size = batch_size
+        self.probe_interval = probe_interval
+        self.on_commit = on_commit
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = FULL')
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+        self._lock = threading.Lock()
+        # config -> lock held from next batch to delete while draining that configuration.
+        self._drain_locks = {}
+        self._wakeup = threading.Condition(self._lock)
+        self._spooled_configs = set(row[0] for row in self._db.execute('SELECT DISTINCT config FROM spool'))
+        self._stopped = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._run, name='sqlconmanager-write-spool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, config, level, op, table, key, values):
+        '''Write now if possible, otherwise spool; return True if written to the database.'''
+
+        with self._lock:
+            spooling = config in self._spooled_configs
+
+        if not spooling:
+            writes = [(op, table, key, values)]
+            engine = self.engine_for(config, level)
+            try:
+                with engine.begin() as connection:
+                    batching.execute_writes(connection, writes)
+            except sqlalchemy.exc.DBAPIError as exc:
+                if not is_outage(engine, exc):
+                    raise
+                logger.warning('Database {0} unreachable, spooling writes: {1}'.format(config, exc))
+            else:
+                if self.on_commit is not None:
+                    self.on_commit(config, writes)
+                return True
+
+        self._spool(config, level, op, table, key, values)
+        return False
+
+    def _spool(self, config, level, op, table, key, values):
+        with self._lock:
+            self._db.execute('INSERT INTO spool (config, level, op, tbl, payload) VALUES (?, ?, ?, ?, ?)',
+                             (config, level, op, table, sqlite3.Binary(pickle.dumps((key, values), 2))))
+            self._db.commit()
+            self._spooled_configs.add(config)
+            self._wakeup.notify_all()
+
+    def pending(self):
+        '''Number of spooled writes.'''
+
+        with self._lock:
+            return self._db.execute('SELECT count(*) FROM spool').fetchone()[0]
+
+    def _next_batch(self, config):
+        '''Oldest run of spooled writes of config sharing one level, up to batch_size.'''
+
+        with self._lock:
+            rows = self._db.execute('SELECT seq, config, level, op, tbl, payload FROM spool WHERE config = ? '
+                                    'ORDER BY seq LIMIT ?', (config, self.batch_size)).fetchall()
+        batch = []
+        for row in rows:
+            if batch and row[1:3] != batch[0][1:3]:
+                break
+            batch.append(row)
+        return batch
+
+    def _apply(self, config, level, rows):
+        writes = []
+        for _, _, _, op, table, payload in rows:
+            key, values = pickle.loads(bytes(payload))
+            writes.append((op, table, key, values))
+        with self.engine_for(config, level).begin() as connection:
+            batching.execute_writes(connection, writes)
+        if self.on_commit is not None:
+            self.on_commit(config, writes)
+
+    def _delete(self, rows, error=None):
+        with self._lock:
+            if error is not None:
+                self._db.executemany('INSERT INTO failed (seq, config, level, op, tbl, payload, error) '
+                                     'VALUES (?, ?, ?, ?, ?, ?, ?)', [row + (error,) for row in rows])
+            self._db.executemany('DELETE FROM spool WHERE seq = ?', [(row[0],) for row in rows])
+            remaining = set(row[0] for row in self._db.execute('SELECT DISTINCT config FROM spool'))
+            self._db.commit()
+            self._spooled_configs = remaining
+
+    def drain_once(self):
+        '''Send one batch; return False if there was nothing to send or the database is still down.'''
+
+        with self._lock:
+            oldest = self._db.execute('SELECT config FROM spool ORDER BY seq LIMIT 1').fetchone()
+            if oldest is None:
+                return False
+            drain_lock = self._drain_locks.setdefault(oldest[0], threading.Lock())
+        with drain_lock:
+            return self._drain_batch(oldest[0])
+
+    def _drain_batch(self, config):
+        batch = self._next_batch(config)
+        if not batch:
+            # Drained meanwhile by another caller.
+            return True
+
+        level = batch[0][2]
+        engine = self.engine_for(config, level)
+        try:
+            self._apply(config, level, batch)
+        except sqlalchemy.exc.DBAPIError as exc:
+            if is_outage(engine, exc):
+                logger.info('Database {0} still unreachable; {1} writes spooled'.format(config, self.pending()))
+                return False
+            # Find the rejected write(s) by replaying one at a time.
+            for row in batch:
+                try:
+                    self._apply(config, level, [row])
+                except sqlalchemy.exc.DBAPIError as row_exc:
+                    if is_outage(engine, row_exc):
+                        return False
+                    logger.error('Spooled write {0} rejected by {1}: {2}'.format(row[0], config, row_exc))
+                    self._delete([row], str(row_exc))
+                else:
+                    self._delete([row])
+            return True
+
+        self._delete(batch)
+        logger.debug('Drained {0} spooled writes to {1}'.format(len(batch), config))
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._spooled_configs and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+
+            try:
+                drained = self.drain_once()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Write spool drain failed: {0}'.format(exc))
+                drained = False
+
+            if not drained:
+                with self._lock:
+                    if not self._stopped:
+                        self._wakeup.wait(self.probe_interval)
+
+    def close(self):
+        '''Stop draining; spooled writes stay on disk for the next WriteSpool on this path.'''
+
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            drain_locks = list(self._drain_locks.values())
+        for drain_lock in drain_locks:
+            drain_lock.acquire()
+        try:
+            with self._lock:
+                self._db.close()
+        finally:
+            for drain_lock in drain_locks:
+                drain_lock.release()
@@ -0,0 +1,78 @@
+'''SQL comment tagging: label statements with their service, configuration, level and call site.'''
+
+import logging
+import os
+import re
+import sys
+
+import sqlalchemy
+
+from sqlconmanager.leaks import is_library_file
+
+logger = logging.getLogger(__name__)
+
+# Anything that could end the comment, or be taken for a bind parameter, is replaced.
+_UNSAFE = re.compile(r"[^\w.:/ <>-]")
+
+
+def _clean(value):
+    return _UNSAFE.sub('_', str(value))
+
+
+class SqlTagger(object):
+    '''Append a comment naming where a statement came from, e.g.
+
+        SELECT ... /* service=billing config=production level=ro site=invoices.py:88:load_invoice */
+
+    so the server's process list, slow query log and statement statistics show which
+    service and code path sent them.  Comments are built once per call site and engine
+    and cached; with call_site=False there is one comment per engine and no stack walk.
+
+    executemany statements are left untagged: the MySQL drivers only rewrite an
+    executemany INSERT into one multi-row INSERT when the statement ends with its
+    VALUES list, and tagging it would cost one round trip per row.
+    '''
+
+    def __init__(self, service, call_site=True):
+        self.service = _clean(service)
+        self.call_site = call_site
+        self._library_code = {}
+
+    def _caller(self):
+        '''(code, line) of the innermost frame outside SQLAlchemy, SQLSoup and this package.'''
+
+        frame = sys._getframe(2)
+        library_code = self._library_code
+        while frame is not None:
+            code = frame.f_code
+            library = library_code.get(code)
+            if library is None:
+                library = library_code[code] = is_library_file(code.co_filename)
+            if not library:
+                return code, frame.f_lineno
+            frame = frame.f_back
+        return None, None
+
+    def attach(self, engine, config_name, security_level):
+        '''Tag every statement executed through engine.'''
+
+        tag = ' /* service={0} config={1} level={2}'.format(self.service, _clean(config_name),
+                                                             _clean(security_level))
+        comments = {}
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if executemany:
+                return statement, parameters
+            key = self._caller() if self.call_site else (None, None)
+            comment = comments.get(key)
+            if comment is None:
+                code, line = key
+                if code is None:
+                    comment = tag + ' */'
+                else:
+                    comment = '{0} site={1}:{2}:{3} */'.format(tag, _clean(os.path.basename(code.co_filename)),
+                                                                line, _clean(code.co_name))
+                comments[key] = comment
+            return statement + comment, parameters
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', before_cursor_execute, retval=True)
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+
+import sqlalchemy
+from nose.tools import assert_raises
+
+from sqlconmanager.batching import BatchWriter
+from sqlconmanager.exceptions import ManagerConnectionException
+
+
+class TestBatchWriter():
+    '''Batch writer tests, against a scratch SQLite file.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(cls.tmpdir, 'batch.db'))
+        cls.engine.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+
+    @classmethod
+    def teardown_class(cls):
+        cls.engine.dispose()
+        shutil.rmtree(cls.tmpdir)
+
+    def count(self):
+        return self.engine.execute("SELECT count(*) FROM test").scalar()
+
+    def test_flush_on_row_count(self):
+        self.engine.execute("DELETE FROM test")
+        writer = BatchWriter(self.engine, max_rows=10, max_delay=None)
+        for i in range(25):
+            writer.insert('test', {'id': i, 'name': 'row'})
+        assert self.count() == 20
+        writer.close()
+        assert self.count() == 25
+
+    def test_update_after_insert_keeps_order(self):
+        self.engine.execute("DELETE FROM test")
+        with BatchWriter(self.engine, max_delay=None) as writer:
+            writer.insert('test', {'id': 1, 'name': 'old'})
+            writer.update('test', {'id': 1}, {'name': 'new'})
+        assert self.engine.execute("SELECT name FROM test WHERE id = 1").scalar() == 'new'
+
+    def test_flush_on_delay(self):
+        self.engine.execute("DELETE FROM test")
+        writer = BatchWriter(self.engine, max_delay=0.05)
+        writer.insert('test', {'id': 1, 'name': 'row'})
+        for _ in range(100):
+            if self.count():
+                break
+            time.sleep(0.05)
+        assert self.count() == 1
+        writer.close()
+
+    def test_closed(self):
+        writer = BatchWriter(self.engine, max_delay=None)
+        writer.close()
+        assert_raises(ManagerConnectionException, writer.insert, 'test', {'id': 1})
+
+    def unreachable(self, name):
+        db_dir = os.path.join(self.tmpdir, name)
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(db_dir, name + '.db'),
+                                          poolclass=sqlalchemy.pool.NullPool)
+        return db_dir, engine
+
+    def test_unwritten_rows_are_kept(self):
+        db_dir, engine = self.unreachable('kept')
+        writer = BatchWriter(engine, max_rows=2, max_delay=None)
+        writer.insert('test', {'id': 1, 'name': 'row'})
+        # Queued, so its failed flush is reported by the next insert, which queues nothing.
+        writer.insert('test', {'id': 2, 'name': 'row'})
+        assert_raises(sqlalchemy.exc.OperationalError, writer.insert, 'test', {'id': 3, 'name': 'row'})
+        assert_raises(sqlalchemy.exc.OperationalError, writer.flush)
+
+        os.mkdir(db_dir)
+        engine.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+        writer.close()
+        assert engine.execute("SELECT count(*) FROM test").scalar() == 2
+        assert writer.failed == []
+
+    def test_rejected_rows_are_set_aside(self):
+        self.engine.execute("DELETE FROM test")
+        self.engine.execute("INSERT INTO test VALUES (1, 'taken')")
+        writer = BatchWriter(self.engine, max_rows=10, max_pending=20, max_delay=None)
+        # Flushes carrying the duplicate neither raise nor hold up the rows queued behind it.
+        for i in range(1, 31):
+            writer.insert('test', {'id': i, 'name': 'row'})
+        writer.close()
+        assert [values['id'] for _, _, _, values in writer.failed] == [1]
+        assert self.count() == 30
+
+    def test_close_reports_unwritten_rows(self):
+        _, engine = self.unreachable('unwritten')
+        writer = BatchWriter(engine, max_delay=None)
+        writer.insert('test', {'id': 1, 'name': 'row'})
+        writer.insert('test', {'id': 2, 'name': 'row'})
+        assert_raises(sqlalchemy.exc.OperationalError, writer.close)
+        assert [values['id'] for _, _, _, values in writer.failed] == [1, 2]
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+from nose.tools import assert_raises
+
+from sqlconmanager.budget import ConnectionBudget
+from sqlconmanager.exceptions import ManagerConnectionException
+
+
+class TestConnectionBudget():
+    '''Connection budget tests; flock() slots conflict within one process too.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_slots(self):
+        budget = ConnectionBudget('slots', 2, lock_dir=self.tmpdir, timeout=0.05)
+        first = budget.acquire()
+        second = budget.acquire()
+        assert_raises(ManagerConnectionException, budget.acquire)
+        budget.release(first)
+        budget.release(budget.acquire())
+        budget.release(second)
+
+    def test_engine_connections_hold_slots(self):
+        budget = ConnectionBudget('engine', 2, lock_dir=self.tmpdir, timeout=0.05)
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(self.tmpdir, 'budget.db'),
+                                          poolclass=sqlalchemy.pool.QueuePool, pool_size=5)
+        budget.attach(engine)
+
+        first = engine.connect()
+        second = engine.connect()
+        assert budget.held() == 2
+        assert_raises(ManagerConnectionException, engine.connect)
+
+        first.close()
+        third = engine.connect()  # reuses the pooled connection, no new slot needed
+        assert budget.held() == 2
+
+        second.close()
+        third.close()
+        engine.dispose()
+        assert budget.held() == 0
@@ -0,0 +1,24 @@
+from sqlconmanager.cache import EntityCache, MISSING
+
+
+class TestEntityCache():
+    '''Entity cache invalidation.'''
+
+    def test_loads_survive_unrelated_invalidations(self):
+        cache = EntityCache()
+        key = ('db', 'test', (1,))
+        generation = cache.generation(key)
+        cache.invalidate(('db', 'test', (2,)))
+        cache.invalidate_table('db', 'other')
+        cache.put(key, 'loaded', generation)
+        assert cache.get(key) == 'loaded'
+
+    def test_loads_racing_an_invalidation_are_not_cached(self):
+        cache = EntityCache()
+        key = ('db', 'test', (1,))
+        for invalidate in (lambda: cache.invalidate(key), lambda: cache.invalidate_table('db', 'test'),
+                           cache.clear):
+            generation = cache.generation(key)
+            invalidate()
+            cache.put(key, 'stale', generation)
+            assert cache.get(key) is MISSING
@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from sqlconmanager import connection_manager
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+CLI_CONFIG = '''
+database_configurations:
+    embedded:
+        dbtype: sqlite
+        dbname: {0}
+    broken:
+        dbtype: sqlite
+        dbname: /nonexistent/directory/broken.db
+'''
+
+
+class TestCommandLine():
+    '''connection_manager.py ping/bench/stats.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.config = os.path.join(cls.tmpdir, 'dbconfig.yaml')
+        with open(cls.config, 'w') as config_file:
+            config_file.write(CLI_CONFIG.format(os.path.join(cls.tmpdir, 'embedded.db')))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def run(self, *argv):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            status = connection_manager.main(['--config', self.config] + list(argv))
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_ping(self):
+        status, output = self.run('ping', '--count', '3')
+        assert status == 1
+        assert 'embedded:ro connect ' in output and 'round trip min ' in output
+        assert 'broken:ro FAILED' in output
+
+    def test_bench(self):
+        status, output = self.run('--level', 'update', 'bench', 'embedded', '--threads', '3', '--queries', '20')
+        assert status == 0
+        assert 'embedded:update 3 threads, 60 queries' in output
+        assert 'p99' in output
+
+    def test_stats(self):
+        status, output = self.run('stats', 'embedded', '--connections', '2')
+        assert status == 0
+        assert 'config=embedded level=ro pool=QueuePool' in output
+        assert 'checkedin=2' in output
+
+    def test_stdout_is_machine_readable(self):
+        # A fresh interpreter, so SQLAlchemy's echo handler would bind to this stdout.
+        output = subprocess.check_output([sys.executable, '-m', 'sqlconmanager.connection_manager',
+                                          '--config', self.config, 'stats', 'embedded'])
+        lines = output.decode('utf-8').splitlines()
+        assert lines and all(line.startswith('config=') for line in lines)
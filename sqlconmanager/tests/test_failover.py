@@ -0,0 +1,117 @@
+import socket
+
+from nose.tools import assert_raises
+
+from sqlconmanager import dialects
+from sqlconmanager.connection_manager import Manager, ManagerConnectionException
+from sqlconmanager.failover import HostSelector, parse_hosts
+
+FAILOVER_CONFIG = '''
+database_configurations:
+    clustered:
+        dbtype: mysql
+        host: db1
+        port: 3306
+        dbname: app
+        hosts: [db1, db2]
+        credentials: {ro: [user, secret]}
+'''
+
+
+class _RecordingDialect(object):
+    '''Stands in for a DBAPI dialect: records the connect parameters and statements.'''
+
+    def __init__(self):
+        self.connects = []
+        self.statements = []
+
+    def create_connect_args(self, url):
+        return [], {'host': 'db1', 'port': 3306, 'user': 'user'}
+
+    def connect(self, *cargs, **cparams):
+        self.connects.append(cparams)
+        return self
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Engine(object):
+    url = None
+
+    def __init__(self):
+        self.dialect = _RecordingDialect()
+
+
+def _listener():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    return server, ('127.0.0.1', server.getsockname()[1])
+
+
+class TestHostSelector():
+    '''Failover between the hosts of a configuration.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.servers = []
+        cls.hosts = []
+        for _ in range(2):
+            server, host = _listener()
+            cls.servers.append(server)
+            cls.hosts.append(host)
+        # A port nothing listens on.
+        server, cls.dead = _listener()
+        server.close()
+
+    @classmethod
+    def teardown_class(cls):
+        for server in cls.servers:
+            server.close()
+
+    def test_parse_hosts(self):
+        assert parse_hosts(['db1:3307', 'db2', {'host': 'db3', 'port': 3308}], 3306) == \
+            [('db1', 3307), ('db2', 3306), ('db3', 3308)]
+
+    def test_probe_skips_down_hosts(self):
+        selector = HostSelector('test', [self.dead] + self.hosts, probe_timeout=0.5)
+        selector.probe()
+        assert selector.down == set([self.dead])
+        assert selector.preferred in self.hosts
+        assert selector.ranked()[0] == selector.preferred
+        assert selector.ranked()[-1] == self.dead
+
+    def test_fail_over_and_back(self):
+        selector = HostSelector('test', self.hosts, probe_timeout=0.5, latency_margin=10)
+        selector.probe()
+        primary = selector.preferred
+
+        selector.mark_down(primary)
+        assert selector.preferred != primary
+        assert selector.ranked()[-1] == primary
+
+        selector.probe()
+        assert primary not in selector.down
+        # Within latency_margin of each other, the current host stays preferred.
+        assert selector.preferred != primary
+
+    def test_cancel_goes_to_the_connection_host(self):
+        engine = _Engine()
+        backend_id = dialects.BackendId(42, ('db2', 3307))
+        dialects.cancel_statement(engine, dialects.MYSQL, backend_id, backend_id.host)
+        assert engine.dialect.connects == [{'host': 'db2', 'port': 3307, 'user': 'user'}]
+        assert engine.dialect.statements == ['KILL QUERY 42']
+
+    def test_cancel_needs_the_host(self):
+        mgr = Manager(FAILOVER_CONFIG)
+        assert_raises(ManagerConnectionException, mgr.cancel, 42, 'clustered')
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+
+from nose.plugins.skip import SkipTest
+
+from sqlconmanager.connection_manager import Manager, ConnectionLevel
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+GREEN_CONFIG = '''
+database_configurations:
+    embedded:
+        dbtype: sqlite
+        dbname: {0}
+        engine_options:
+            pool_size: 2
+            max_overflow: 0
+'''
+
+
+class TestGreenPool():
+    '''Cooperative mode: greenlets share a small pool fairly.'''
+
+    @classmethod
+    def setup_class(cls):
+        if gevent is None:
+            raise SkipTest('gevent is not installed')
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.mgr = Manager(GREEN_CONFIG.format(os.path.join(cls.tmpdir, 'green.db')), cooperative=True)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.mgr.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_waiters_served_in_order(self):
+        engine = self.mgr._engine_for('embedded', ConnectionLevel.UPDATE)
+        assert type(engine.pool).__name__ == 'GreenQueuePool'
+
+        served = []
+
+        def request(number):
+            connection = engine.connect()
+            served.append(number)
+            gevent.sleep(0.01)
+            connection.close()
+
+        greenlets = [gevent.spawn(request, number) for number in range(20)]
+        gevent.joinall(greenlets, timeout=5)
+        assert all(greenlet.successful() for greenlet in greenlets)
+        assert served == list(range(20))
+        assert engine.pool.checkedout() == 0
+
+    def test_get_connection_validates(self):
+        conn = self.mgr.get_connection(self.mgr.config_stream, config='embedded', validate=True)
+        assert conn.connection().execute("select 1").scalar() == 1
+        self.mgr.release()
+        self.mgr.unset_engine()
@@ -0,0 +1,32 @@
+import sqlalchemy
+
+from sqlconmanager.leaks import LeakDetector
+
+
+class TestLeakDetector():
+    '''Leak detector tests, against an in-memory SQLite engine.'''
+
+    def test_reports_held_connections(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        detector = LeakDetector(threshold=0, sample_rate=1.0)
+        detector.attach(engine, 'memory')
+
+        held = engine.connect()
+        leaks = detector.leaks()
+        assert len(leaks) == 1
+        assert leaks[0][0] == 'memory'
+        assert 'test_leaks.py' in leaks[0][2]
+        assert detector.top_call_sites()[0][1] == 1
+
+        held.close()
+        assert detector.leaks() == []
+
+    def test_unsampled_checkouts_have_no_call_site(self):
+        engine = sqlalchemy.create_engine('sqlite://')
+        detector = LeakDetector(threshold=0, sample_rate=0)
+        detector.attach(engine, 'memory')
+
+        held = engine.connect()
+        assert detector.leaks()[0][2] is None
+        assert detector.top_call_sites() == []
+        held.close()
@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+
+import sqlalchemy
+
+from sqlconmanager.maintenance import PoolMaintainer
+
+
+class TestPoolMaintainer():
+    '''Pool maintenance passes against a scratch SQLite file.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def make_engine(self, **pool_args):
+        return sqlalchemy.create_engine('sqlite:///' + os.path.join(self.tmpdir, 'pool.db'),
+                                        poolclass=sqlalchemy.pool.QueuePool, **pool_args)
+
+    def test_warm_and_reap(self):
+        engine = self.make_engine(pool_size=5)
+        maintainer = PoolMaintainer(lambda: [(engine, None)], min_idle=2, idle_timeout=0)
+
+        maintainer.run_once()
+        assert engine.pool.checkedin() == 2
+
+        connections = [engine.connect() for _ in range(4)]
+        for connection in connections:
+            connection.close()
+        assert engine.pool.checkedin() == 4
+
+        maintainer.run_once()
+        assert engine.pool.checkedin() == 2
+        assert engine.pool.checkedout() == 0
+        engine.dispose()
+
+    def test_refresh_before_recycle(self):
+        engine = self.make_engine(pool_size=2, pool_recycle=60)
+        maintainer = PoolMaintainer(lambda: [(engine, None)], min_idle=1, recycle_margin=120)
+
+        maintainer.run_once()
+        first = engine.connect()
+        dbapi_connection = first.connection.connection
+        first.close()
+
+        maintainer.run_once()
+        second = engine.connect()
+        assert second.connection.connection is not dbapi_connection
+        second.close()
+        engine.dispose()
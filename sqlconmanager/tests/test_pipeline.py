@@ -0,0 +1,67 @@
+import sqlalchemy
+from sqlalchemy.dialects.mysql import pymysql
+
+from sqlconmanager.pipeline import Pipeline
+
+
+class _RecordingConnection(object):
+    '''Stands in for a DBAPI connection running a multi-statement query of two inserts.'''
+
+    def __init__(self):
+        self.executed = []
+        self.description = None
+        self.rowcount = 1
+        self._sets = 2
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.executed.append((sql, params))
+
+    def nextset(self):
+        self._sets -= 1
+        return self._sets > 0
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Engine(object):
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.connection = _RecordingConnection()
+
+    def raw_connection(self):
+        return self.connection
+
+
+class TestPipeline():
+    '''Multi-statement pipelines on a pyformat (PyMySQL) dialect.'''
+
+    def test_parameters_are_bound_per_statement(self):
+        engine = _Engine(pymysql.dialect(paramstyle='pyformat'))
+        pipeline = Pipeline(engine, multi_statements=True)
+        pipeline.add("INSERT INTO test (id, name) VALUES (:id, :name)", id=1, name='first')
+        pipeline.add("INSERT INTO test (id, name) VALUES (:id, :name)", id=2, name='second')
+        assert pipeline.execute() == [1, 1]
+
+        sql, params = engine.connection.executed[0]
+        assert sql == "INSERT INTO test (id, name) VALUES (%s, %s);\nINSERT INTO test (id, name) VALUES (%s, %s)"
+        assert params == [1, 'first', 2, 'second']
+        assert engine.dialect.paramstyle == 'pyformat'
+
+    def test_constructs(self):
+        table = sqlalchemy.table('test', sqlalchemy.column('id'))
+        pipeline = Pipeline(_Engine(pymysql.dialect(paramstyle='pyformat')), multi_statements=True)
+        pipeline.add(table.select().where(table.c.id == 5))
+        pipeline.add(table.delete().where(table.c.id == 6))
+        sql, params = pipeline._render(pipeline._statements)
+        assert sql.count('%s') == 2 and '%(' not in sql
+        assert params == [5, 6]
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from nose.tools import assert_raises
+
+from sqlconmanager import priority
+from sqlconmanager.connection_manager import Manager, ConnectionLevel
+from sqlconmanager.exceptions import ManagerConnectionException
+from sqlconmanager.priority import PriorityGate
+
+
+def _acquire_in_thread(gate, level, order):
+    def run():
+        gate.acquire(level)
+        order.append(level)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+class TestPriorityGate():
+    '''Admission by priority class.'''
+
+    def test_reserved_slots(self):
+        gate = PriorityGate('test', 2, {priority.HIGH: 1}, aging=0)
+        gate.acquire(priority.LOW)
+        assert_raises(ManagerConnectionException, gate.acquire, priority.LOW, 0.05)
+        gate.acquire(priority.HIGH, 0.05)
+        assert gate.in_use == 2
+
+    def test_high_priority_served_first(self):
+        gate = PriorityGate('test', 1, aging=0)
+        gate.acquire(priority.NORMAL)
+        order = []
+        low = _acquire_in_thread(gate, priority.LOW, order)
+        time.sleep(0.05)
+        high = _acquire_in_thread(gate, priority.HIGH, order)
+        time.sleep(0.05)
+
+        gate.release()
+        high.join()
+        gate.release()
+        low.join()
+        assert order == [priority.HIGH, priority.LOW]
+
+    def test_aging_prevents_starvation(self):
+        gate = PriorityGate('test', 2, aging=0.05)
+        gate.acquire(priority.NORMAL)
+        gate.acquire(priority.NORMAL)
+        order = []
+        low = _acquire_in_thread(gate, priority.LOW, order)
+        time.sleep(0.2)
+        normal = _acquire_in_thread(gate, priority.NORMAL, order)
+        time.sleep(0.05)
+
+        # The LOW waiter has aged past the newer NORMAL one.
+        gate.release()
+        low.join()
+        gate.release()
+        normal.join()
+        assert order == [priority.LOW, priority.NORMAL]
+
+    def test_aging_keeps_reserved_slots(self):
+        gate = PriorityGate('test', 2, {priority.HIGH: 1}, aging=0.05)
+        gate.acquire(priority.LOW)
+        # However long it waits, LOW never takes the slot HIGH reserves...
+        assert_raises(ManagerConnectionException, gate.acquire, priority.LOW, 0.3)
+        # ...and an aged LOW waiter does not hold up HIGH.
+        order = []
+        low = _acquire_in_thread(gate, priority.LOW, order)
+        time.sleep(0.2)
+        gate.acquire(priority.HIGH, 0.05)
+        assert gate.in_use == 2
+        gate.release()
+        gate.release()
+        low.join()
+        assert order == [priority.LOW]
+
+
+class TestManagerPriority():
+    '''Admission of Manager connections and batch writer flushes.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.mgr = Manager('''
+database_configurations:
+    gated:
+        dbtype: sqlite
+        dbname: {0}
+        priority: {{capacity: 1, timeout: 0.05}}
+'''.format(os.path.join(cls.tmpdir, 'gated.db')))
+        with cls.mgr.transaction('gated') as db:
+            db.execute("CREATE TABLE test (id int PRIMARY KEY)")
+
+    @classmethod
+    def teardown_class(cls):
+        cls.mgr.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_batch_writer_flush_is_gated(self):
+        writer = self.mgr.batch_writer('gated', max_delay=None)
+        writer.insert('test', {'id': 1})
+        with self.mgr.connection('gated', ConnectionLevel.ADMIN):
+            assert_raises(ManagerConnectionException, writer.flush)
+        writer.close()
+        with self.mgr.connection('gated') as db:
+            assert db.test.count() == 1
@@ -0,0 +1,73 @@
+from nose.tools import assert_raises
+
+from sqlconmanager.connection_manager import Manager, ManagerConnectionException
+from sqlconmanager.sharding import ShardMap, HASH, RANGE
+
+SHARD_CONFIG = '''
+database_configurations:
+    shard_a: {credentials: {}, host: host, port: 0, dbname: a, dbtype: mysql}
+    shard_b: {credentials: {}, host: host, port: 0, dbname: b, dbtype: mysql}
+    shard_c: {credentials: {}, host: host, port: 0, dbname: c, dbtype: mysql}
+shard_maps:
+    default:
+        strategy: hash
+        buckets: 16
+        shards: [shard_a, shard_b]
+    by_id:
+        strategy: range
+        ranges:
+            - [0, shard_a]
+            - [1000, shard_b]
+'''
+
+
+class TestShardMap():
+    '''Shard map routing tests (no database needed).'''
+
+    def test_hash_is_stable(self):
+        shard_map = ShardMap('tenants', HASH, shards=['shard_a', 'shard_b'], buckets=16)
+        routes = [shard_map.lookup('tenant-{0}'.format(i)) for i in range(100)]
+        assert routes == [shard_map.lookup('tenant-{0}'.format(i)) for i in range(100)]
+        assert set(routes) == set(['shard_a', 'shard_b'])
+
+    def test_range(self):
+        shard_map = ShardMap('ids', RANGE, ranges=[[1000, 'shard_b'], [0, 'shard_a']])
+        assert shard_map.lookup(0) == 'shard_a'
+        assert shard_map.lookup(999) == 'shard_a'
+        assert shard_map.lookup(1000) == 'shard_b'
+        assert_raises(KeyError, shard_map.lookup, -1)
+
+    def test_move(self):
+        shard_map = ShardMap('tenants', HASH, shards=['shard_a'], buckets=4)
+        shard_map.move(2, 'shard_c')
+        assert shard_map.config_names() == set(['shard_a', 'shard_c'])
+
+        shard_map = ShardMap('ids', RANGE, ranges=[[0, 'shard_a'], [1000, 'shard_b']])
+        shard_map.move(1000, 'shard_c')
+        assert shard_map.lookup(5000) == 'shard_c'
+        assert_raises(KeyError, shard_map.move, 500, 'shard_c')
+
+    def test_bucket_bounds(self):
+        shard_map = ShardMap('tenants', HASH, shards=['shard_a'], buckets=4)
+        assert_raises(IndexError, shard_map.move, -1, 'shard_c')
+        assert_raises(IndexError, shard_map.move, 4, 'shard_c')
+        assert shard_map.config_names() == set(['shard_a'])
+        assert_raises(IndexError, ShardMap, 'tenants', HASH, shards=['shard_a'], buckets=4, assignments={-1: 'shard_c'})
+
+    def test_manager_routing(self):
+        mgr = Manager(SHARD_CONFIG)
+        assert mgr.shard_for(5, 'by_id') == 'shard_a'
+        assert mgr.shard_for(1005, 'by_id') == 'shard_b'
+        assert mgr.shard_for('tenant-1') in ('shard_a', 'shard_b')
+
+        mgr.move_shard(1000, 'shard_c', 'by_id')
+        assert mgr.shard_for(1005, 'by_id') == 'shard_c'
+
+        assert_raises(ManagerConnectionException, mgr.move_shard, 1000, 'tequilla', 'by_id')
+        assert_raises(ManagerConnectionException, mgr.shard_for, 5, 'no_such_map')
+        assert_raises(ManagerConnectionException, mgr.shard_for, -5, 'by_id')
+        assert_raises(ManagerConnectionException, mgr.move_shard, -1, 'shard_c')
+
+    def test_unknown_shard_config(self):
+        mgr = Manager(SHARD_CONFIG.replace('[shard_a, shard_b]', '[shard_a, shard_x]'))
+        assert_raises(ManagerConnectionException, mgr.shard_for, 'tenant-1')
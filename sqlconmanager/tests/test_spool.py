@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from nose.tools import assert_raises
+
+from sqlconmanager.spool import WriteSpool
+
+
+class TestWriteSpool():
+    '''Write spool tests: a SQLite file whose directory disappears stands in for an outage.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_spool_and_drain(self):
+        db_dir = os.path.join(self.tmpdir, 'remote')
+        db_path = os.path.join(db_dir, 'remote.db')
+        engine = sqlalchemy.create_engine('sqlite:///' + db_path, poolclass=sqlalchemy.pool.NullPool)
+        spool = WriteSpool(os.path.join(self.tmpdir, 'spool.db'), lambda config, level: engine,
+                           background=False)
+
+        # The database file cannot be opened: writes are spooled, in order.
+        assert spool.write('remote', 'update', 'insert', 'test', {}, {'id': 1, 'name': 'first'}) is False
+        assert spool.write('remote', 'update', 'update', 'test', {'id': 1}, {'name': 'second'}) is False
+        assert spool.pending() == 2
+        assert spool.drain_once() is False
+
+        os.mkdir(db_dir)
+        engine.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+        assert spool.drain_once() is True
+        assert spool.pending() == 0
+        assert engine.execute("SELECT name FROM test WHERE id = 1").scalar() == 'second'
+
+        # Back to normal: writes go straight through.
+        assert spool.write('remote', 'update', 'insert', 'test', {}, {'id': 2, 'name': 'direct'}) is True
+        spool.close()
+
+    def test_rejected_writes_are_set_aside(self):
+        db_dir = os.path.join(self.tmpdir, 'rejects')
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(db_dir, 'rejects.db'),
+                                          poolclass=sqlalchemy.pool.NullPool)
+        spool = WriteSpool(os.path.join(self.tmpdir, 'rejects-spool.db'), lambda config, level: engine,
+                           background=False)
+        for values in ({'id': 1, 'name': 'ok'}, {'id': 2, 'name': None}, {'id': 3, 'name': 'ok'}):
+            spool.write('rejects', 'update', 'insert', 'test', {}, values)
+
+        os.mkdir(db_dir)
+        engine.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45) NOT NULL)")
+        assert spool.drain_once() is True
+        assert spool.pending() == 0
+        assert engine.execute("SELECT count(*) FROM test").scalar() == 2
+        assert spool._db.execute("SELECT seq FROM failed").fetchall() == [(2,)]
+        spool.close()
+
+    def test_statement_errors_are_not_outages(self):
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(self.tmpdir, 'errors.db'),
+                                          poolclass=sqlalchemy.pool.NullPool)
+        engine.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+        spool = WriteSpool(os.path.join(self.tmpdir, 'errors-spool.db'), lambda config, level: engine,
+                           background=False)
+        assert_raises(sqlalchemy.exc.OperationalError, spool.write, 'errors', 'update', 'insert', 'test', {},
+                      {'id': 1, 'nope': 'unknown column'})
+        assert spool.pending() == 0
+        assert spool.write('errors', 'update', 'insert', 'test', {}, {'id': 1, 'name': 'direct'}) is True
+        spool.close()
+
+    def test_concurrent_drains(self):
+        db_dir = os.path.join(self.tmpdir, 'concurrent')
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(db_dir, 'concurrent.db'),
+                                          poolclass=sqlalchemy.pool.NullPool)
+        spool = WriteSpool(os.path.join(self.tmpdir, 'concurrent-spool.db'), lambda config, level: engine,
+                           batch_size=5, probe_interval=0.01)
+        for i in range(50):
+            spool.write('concurrent', 'update', 'insert', 'test', {}, {'id': i, 'name': 'row'})
+
+        # Bring the database up with its table at once, or the drain thread could reject rows.
+        staging = os.path.join(self.tmpdir, 'concurrent-staging')
+        os.mkdir(staging)
+        sqlite3.connect(os.path.join(staging, 'concurrent.db')).execute(
+            "CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+        os.rename(staging, db_dir)
+        while spool.pending():
+            spool.drain_once()
+        spool.close()
+        assert engine.execute("SELECT count(*) FROM test").scalar() == 50
+
+    def test_writes_do_not_wait_for_drains(self):
+        connecting, reachable = threading.Event(), threading.Event()
+
+        def connect():
+            connecting.set()
+            reachable.wait(5)
+            raise sqlite3.OperationalError('unable to open database file')
+
+        down = sqlalchemy.create_engine('sqlite://', creator=connect, poolclass=sqlalchemy.pool.NullPool)
+        up = sqlalchemy.create_engine('sqlite:///' + os.path.join(self.tmpdir, 'up.db'),
+                                      poolclass=sqlalchemy.pool.NullPool)
+        up.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+        engines = {'down': down, 'up': up}
+        spool = WriteSpool(os.path.join(self.tmpdir, 'waits-spool.db'), lambda config, level: engines[config],
+                           background=False)
+        reachable.set()
+        assert spool.write('down', 'update', 'insert', 'test', {}, {'id': 1, 'name': 'spooled'}) is False
+
+        reachable.clear()
+        connecting.clear()
+        drain = threading.Thread(target=spool.drain_once)
+        drain.start()
+        assert connecting.wait(5)
+        # The drain is stuck connecting to 'down'; neither direct nor spooled writes wait for it.
+        written = []
+        writer = threading.Thread(target=lambda: written.extend([
+            spool.write('up', 'update', 'insert', 'test', {}, {'id': 1, 'name': 'direct'}),
+            spool.write('down', 'update', 'insert', 'test', {}, {'id': 2, 'name': 'spooled'})]))
+        writer.start()
+        writer.join(2)
+        assert written == [True, False] and drain.is_alive()
+        reachable.set()
+        drain.join()
+        assert spool.pending() == 2
+        spool.close()
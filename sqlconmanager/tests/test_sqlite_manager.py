@@ -0,0 +1,495 @@
+import gc
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import weakref
+
+import sqlalchemy
+import sqlsoup
+
+from nose.tools import assert_raises
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+from sqlconmanager import bulk
+from sqlconmanager import dialects
+from sqlconmanager import reflection
+from sqlconmanager import transfer
+from sqlconmanager.connection_manager import Manager, ConnectionLevel, ManagerConnectionException
+from sqlconmanager.lazy import LazySoup
+
+SQLITE_CONFIG = '''
+database_configurations:
+    embedded:
+        dbtype: sqlite
+        dbname: {0}
+        preload_tables:
+            - test
+            - reference
+            - nope
+        mirrored_tables:
+            refresh: 3600
+            tables:
+                reference:
+                    version_column: version
+    memory:
+        dbtype: sqlite
+        dbname: ":memory:"
+    replica:
+        dbtype: sqlite
+        dbname: {1}
+'''
+
+
+class TestSQLiteManager():
+    '''Manager tests against the embedded SQLite backend.'''
+
+    @classmethod
+    def setup_class(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.mgr = Manager(SQLITE_CONFIG.format(os.path.join(cls.tmpdir, 'embedded.db'),
+                                            os.path.join(cls.tmpdir, 'replica.db')))
+        with cls.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE test (id int PRIMARY KEY, name varchar(45))")
+            db.execute("INSERT INTO test (id, name) VALUES (1, 'testing')")
+            db.execute("CREATE TABLE reference (code varchar(3) PRIMARY KEY, label varchar(45), version int)")
+            db.execute("INSERT INTO reference (code, label, version) VALUES ('USD', 'Dollar', 1)")
+
+    @classmethod
+    def teardown_class(cls):
+        cls.mgr.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_get_connection(self):
+        conn = self.mgr.get_connection(self.mgr.config_stream, config='embedded')
+        assert conn.test.all()[0].name == 'testing'
+        self.mgr.release()
+        self.mgr.unset_engine()
+
+    def test_get_connection_is_lazy(self):
+        conn = self.mgr.get_connection(self.mgr.config_stream, config='embedded')
+        assert isinstance(conn, LazySoup)
+        assert conn._soup is None and conn.bind.pool.checkedout() == 0
+        assert conn.execute("SELECT name FROM test WHERE id = :id", id=1).scalar() == 'testing'
+        assert conn.test.get(1).name == 'testing'
+        self.mgr.release()
+        self.mgr.unset_engine()
+
+        conn = self.mgr.get_connection(self.mgr.config_stream, config='embedded', validate=True)
+        assert not isinstance(conn, LazySoup)
+        self.mgr.release()
+        self.mgr.unset_engine()
+
+    def test_lazy_execute_is_transactional(self):
+        conn = self.mgr.get_connection(self.mgr.config_stream, config='embedded', security_level=ConnectionLevel.UPDATE)
+        conn.execute("INSERT INTO test (id, name) VALUES (5, 'rolled back')")
+        conn.rollback()
+        assert conn.execute("SELECT count(*) FROM test WHERE id = 5").scalar() == 0
+        self.mgr.release()
+        self.mgr.unset_engine()
+
+    def test_lazy_connection_is_validated_on_first_use(self):
+        class FlakyManager(Manager):
+            failures = 1
+
+            def validate_connection(self, db):
+                if self.failures:
+                    self.failures -= 1
+                    raise OperationalError('select 1', {}, Exception('server has gone away'))
+                return super(FlakyManager, self).validate_connection(db)
+
+        with FlakyManager(self.mgr.config_stream) as mgr:
+            conn = mgr.get_connection(mgr.config_stream, config='embedded')
+            first_engine = conn.bind
+            statements = []
+            event.listen(first_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            # Raw statements skip the validation (and the SQLSoup).
+            assert conn.execute("SELECT count(*) FROM test WHERE id = 1").scalar() == 1
+            assert statements == ["SELECT count(*) FROM test WHERE id = 1"]
+            assert mgr.failures == 1 and conn._soup is None
+            mgr.release()
+            assert conn.test.get(1).name == 'testing'
+            assert mgr.failures == 0
+            assert conn.bind is mgr.db_engine and conn.bind is not first_engine
+
+    def test_wal_and_read_only(self):
+        with self.mgr.connection('embedded') as db:
+            assert db.execute("PRAGMA journal_mode").scalar() == 'wal'
+            assert_raises(OperationalError, db.execute, "INSERT INTO test (id, name) VALUES (2, 'nope')")
+
+    def test_transaction_rolls_back(self):
+        try:
+            with self.mgr.transaction('embedded') as db:
+                db.execute("INSERT INTO test (id, name) VALUES (3, 'rolled back')")
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with self.mgr.connection('embedded') as db:
+            assert db.test.get(3) is None
+
+    def test_memory_database_is_shared(self):
+        with self.mgr.transaction('memory', ConnectionLevel.UPDATE) as db:
+            db.execute("CREATE TABLE shared (id int PRIMARY KEY)")
+            db.execute("INSERT INTO shared (id) VALUES (1)")
+        with self.mgr.connection('memory', ConnectionLevel.UPDATE) as db:
+            assert db.shared.count() == 1
+
+    def test_script_mode(self):
+        with Manager(self.mgr.config_stream, script_mode=True) as mgr:
+            conn = mgr.get_connection(mgr.config_stream, config='embedded')
+            assert isinstance(conn.bind.pool, NullPool)
+            assert conn.test.get(1).name == 'testing'
+        assert mgr.db_engine is None
+
+    def test_unknown_poolclass(self):
+        mgr = Manager('database_configurations: {memory: {dbtype: sqlite, engine_options: {poolclass: NoSuchPool}}}')
+        with assert_raises(ManagerConnectionException) as raised:
+            mgr.get_engine('memory')
+        assert 'memory' in str(raised.exception) and 'NoSuchPool' in str(raised.exception)
+
+    def test_entity_cache(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("INSERT INTO test (id, name) VALUES (10, 'cached')")
+
+        entity = self.mgr.get_entity('test', 10, 'embedded')
+        assert entity.name == 'cached'
+        assert self.mgr.get_entity('test', 10, 'embedded') is entity
+
+        with self.mgr.transaction('embedded') as db:
+            db.test.get(10).name = 'updated'
+        assert self.mgr.get_entity('test', 10, 'embedded').name == 'updated'
+
+        with self.mgr.batch_writer('embedded', max_delay=None) as writer:
+            writer.update('test', {'id': 10}, {'name': 'batched'})
+        assert self.mgr.get_entity('test', 10, 'embedded').name == 'batched'
+
+    def test_entity_cache_unique_key(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE account (id int PRIMARY KEY, email varchar(45) UNIQUE, name varchar(45))")
+            db.execute("INSERT INTO account (id, email, name) VALUES (1, 'a@example.com', 'old')")
+
+        assert self.mgr.get_entity('account', 1, 'embedded').name == 'old'
+        self.mgr.write('account', {'name': 'newer'}, key={'email': 'a@example.com'}, config='embedded')
+        assert self.mgr.get_entity('account', 1, 'embedded').name == 'newer'
+
+    def test_session_events_are_per_manager(self):
+        session_class = sqlsoup.Session.session_factory.class_
+
+        def listeners():
+            return [len(getattr(session_class.dispatch, name)._clslevel.get(session_class, ()))
+                    for name in ('after_flush', 'after_commit', 'loaded_as_persistent')]
+
+        before = listeners()
+        with Manager(self.mgr.config_stream) as mgr:
+            mgr.limit_identity_maps(10)
+            conn = mgr.get_connection(mgr.config_stream, config='embedded')
+            assert conn.session is not sqlsoup.Session
+        assert listeners() == before
+
+    def test_fetch_by_keys(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE keyed (id int PRIMARY KEY, value int)")
+            db.connection().execute(text("INSERT INTO keyed (id, value) VALUES (:id, :value)"),
+                                    [{'id': i, 'value': i * 2} for i in range(0, 3000, 3)])
+
+        keys = list(range(3000)) + [0, 3]
+        rows = list(self.mgr.fetch_by_keys('keyed', 'id', keys, 'embedded', chunk_size=100))
+        assert sorted(row.id for row in rows) == list(range(0, 3000, 3))
+
+        # READ_ONLY SQLite connections cannot create the temporary table; UPDATE ones can.
+        for level in (ConnectionLevel.READ_ONLY, ConnectionLevel.UPDATE):
+            rows = list(self.mgr.fetch_by_keys('keyed', 'id', keys, 'embedded', level, temp_table_threshold=10))
+            assert sorted(row.value for row in rows) == list(range(0, 6000, 6))
+
+    def autocommit_table(self, name):
+        # As READ_ONLY engines are by default: psycopg2 cannot stream in autocommit mode.
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(self.tmpdir, name + '.db'),
+                                          isolation_level='AUTOCOMMIT')
+        engine.execute("CREATE TABLE {0} (id int PRIMARY KEY)".format(name))
+        engine.execute(text("INSERT INTO {0} (id) VALUES (:id)".format(name)), [{'id': i} for i in range(10)])
+        table = sqlalchemy.Table(name, sqlalchemy.MetaData(), autoload=True, autoload_with=engine)
+        begins = []
+        event.listen(engine, 'begin', begins.append)
+        return engine, table, begins
+
+    def test_copy_streams_in_a_transaction(self):
+        engine, table, begins = self.autocommit_table('streamed')
+        with engine.connect() as connection:
+            assert connection.connection.connection.isolation_level is None
+            assert dialects.streaming(connection).connection.connection.isolation_level is not None
+
+        dst_engine = sqlalchemy.create_engine('sqlite://')
+        dst_table = table.tometadata(sqlalchemy.MetaData())
+        dst_table.create(dst_engine)
+        assert transfer.copy_range(engine, table, dst_engine, dst_table, 'id', None, None, None) == 10
+        assert len(begins) == 1
+        engine.dispose()
+
+    def test_fetch_joined_stops_early(self):
+        engine, table, begins = self.autocommit_table('joined')
+        rows = bulk.fetch_joined(engine, table, 'id', list(range(5)))
+        next(rows)
+        # The result is closed before the temporary table is dropped.
+        rows.close()
+        # Loading the keys, then streaming the join.
+        assert len(begins) == 2
+        engine.dispose()
+
+    def test_mirror(self):
+        mirror = self.mgr.mirror('embedded')
+        held = mirror.reference.get('USD')
+        listed = mirror.reference.all()
+        assert held.label == 'Dollar'
+        assert mirror.bind is not self.mgr._engine_for('embedded', ConnectionLevel.READ_ONLY)
+
+        with self.mgr.transaction('embedded') as db:
+            db.execute("UPDATE reference SET label = 'US Dollar', version = 2 WHERE code = 'USD'")
+            db.execute("INSERT INTO reference (code, label, version) VALUES ('EUR', 'Euro', 2)")
+        self.mgr._mirrors['embedded'].refresh()
+
+        assert mirror.reference.get('USD').label == 'US Dollar'
+        assert sorted(row.label for row in mirror.reference.all()) == ['Euro', 'US Dollar']
+        assert held.label == 'US Dollar' and listed[0] is held
+        assert mirror.reference.count() == 2
+        assert_raises(ManagerConnectionException, self.mgr.mirror, 'memory')
+
+    def test_copy_table(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE source (id int PRIMARY KEY, value int)")
+            db.connection().execute(text("INSERT INTO source (id, value) VALUES (:id, :value)"),
+                                    [{'id': i, 'value': i % 7} for i in range(1, 1001)])
+        with self.mgr.transaction('replica', ConnectionLevel.UPDATE) as db:
+            db.execute("CREATE TABLE source (id int PRIMARY KEY, value int)")
+
+        checkpoint = os.path.join(self.tmpdir, 'copy.json')
+        copied = self.mgr.copy_table('embedded', 'replica', 'source', where='value > 0', workers=2, batch_size=50,
+                                     checkpoint=checkpoint)
+        assert copied == 1000 - 1000 // 7
+        assert not os.path.exists(checkpoint)
+        with self.mgr.connection('replica') as db:
+            assert db.source.count() == copied
+            assert db.source.filter_by(value=0).count() == 0
+
+    def test_copy_table_resume_keeps_rows_outside_the_copy(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE resumed (id int PRIMARY KEY, value int)")
+            db.connection().execute(text("INSERT INTO resumed (id, value) VALUES (:id, :value)"),
+                                    [{'id': i, 'value': i % 2} for i in range(1, 11)])
+        with self.mgr.transaction('replica', ConnectionLevel.UPDATE) as db:
+            db.execute("CREATE TABLE resumed (id int PRIMARY KEY, value int)")
+            db.execute("INSERT INTO resumed (id, value) VALUES (100, 0)")  # not part of the copy
+            db.execute("INSERT INTO resumed (id, value) VALUES (1, 1)")  # copied before the interruption
+
+        checkpoint = os.path.join(self.tmpdir, 'resume.json')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump({'signature': ['embedded', 'replica', 'resumed', 'value = 1'],
+                       'ranges': [[None, None, None, False]]}, checkpoint_file)
+        copied = self.mgr.copy_table('embedded', 'replica', 'resumed', where='value = 1', workers=1,
+                                     checkpoint=checkpoint)
+        assert copied == 5
+        with self.mgr.connection('replica') as db:
+            assert sorted(row.id for row in db.resumed.all()) == [1, 3, 5, 7, 9, 100]
+
+    def test_run_transaction_retries(self):
+        attempts = []
+
+        def work(db):
+            attempts.append(db)
+            if len(attempts) < 3:
+                raise OperationalError('UPDATE test', {}, sqlite3.OperationalError('database is locked'))
+            db.execute("INSERT INTO test (id, name) VALUES (30, 'retried')")
+            return len(attempts)
+
+        assert self.mgr.run_transaction(work, 'embedded', base_delay=0.001) == 3
+        with self.mgr.connection('embedded') as db:
+            assert db.test.get(30).name == 'retried'
+        (call_site, retries, exhausted), = self.mgr.retry_stats.report()
+        assert 'test_run_transaction_retries' in call_site and retries == 2 and exhausted == 0
+
+        def failing(db):
+            raise OperationalError('UPDATE test', {}, sqlite3.OperationalError('no such table: nope'))
+
+        assert_raises(OperationalError, self.mgr.run_transaction, failing, 'embedded')
+        assert self.mgr.retry_stats.report()[0][1] == 2
+
+    def test_sql_tags(self):
+        statements = []
+        with Manager(self.mgr.config_stream) as mgr:
+            mgr.enable_sql_tags('billing')
+            for level in (ConnectionLevel.READ_ONLY, ConnectionLevel.UPDATE):
+                event.listen(mgr._engine_for('embedded', level), 'after_cursor_execute',
+                             lambda *args: statements.append(args[2]))
+            with mgr.connection('embedded') as db:
+                assert db.test.get(1).name == 'testing'
+            tagged = statements[-1]
+            with mgr.transaction('embedded', ConnectionLevel.UPDATE) as db:
+                db.connection().execute(text("INSERT INTO test (id, name) VALUES (:id, :name)"),
+                                        [{'id': 20, 'name': 'many'}, {'id': 21, 'name': 'many'}])
+                db.execute("DELETE FROM test WHERE id IN (20, 21)")
+
+        assert tagged.startswith('SELECT')
+        assert ' /* service=billing config=embedded level=ro site=test_sqlite_manager.py:' in tagged
+        assert tagged.endswith(':test_sql_tags */')
+        assert "INSERT INTO test (id, name) VALUES (?, ?)" in statements
+
+    def test_pipeline(self):
+        pipeline = self.mgr.pipeline('embedded', ConnectionLevel.UPDATE)
+        pipeline.add("INSERT INTO test (id, name) VALUES (:id, :name)", id=40, name='piped')
+        pipeline.add("SELECT name FROM test WHERE id = :id", id=40)
+        pipeline.add("SELECT count(*) AS n FROM test WHERE id IN (1, 40)")
+        inserted, names, counts = pipeline.execute()
+        assert inserted == 1
+        assert names == [{'name': 'piped'}]
+        assert counts == [{'n': 2}]
+        assert len(pipeline) == 0
+
+    def test_iter_pages(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE paged (id int PRIMARY KEY, bucket int)")
+            db.connection().execute(text("INSERT INTO paged (id, bucket) VALUES (:id, :bucket)"),
+                                    [{'id': i, 'bucket': i % 5} for i in range(250)])
+
+        pages = list(self.mgr.iter_pages('paged', 'bucket', 40, where='id >= 10', config='embedded'))
+        assert [len(page) for page in pages] == [40] * 6
+        rows = [(row.bucket, row.id) for page in pages for row in page]
+        assert rows == sorted((i % 5, i) for i in range(10, 250))
+
+        pages = list(self.mgr.iter_pages('paged', 'id', 50, config='embedded', prefetch=False))
+        assert [len(page) for page in pages] == [50] * 5
+
+    def test_iter_pages_nullable_key(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE nullable_paged (id int PRIMARY KEY, bucket int)")
+            db.connection().execute(text("INSERT INTO nullable_paged (id, bucket) VALUES (:id, :bucket)"),
+                                    [{'id': i, 'bucket': None if i % 3 == 0 else i % 5} for i in range(100)])
+
+            db.execute("CREATE TABLE nullable_pairs (id int PRIMARY KEY, a int, b int)")
+            db.connection().execute(text("INSERT INTO nullable_pairs (id, a, b) VALUES (:id, :a, :b)"),
+                                    [{'id': i, 'a': None if i % 2 else i % 3, 'b': None if i % 5 else i % 7}
+                                     for i in range(100)])
+
+        engine = self.mgr._engine_for('embedded', ConnectionLevel.READ_ONLY)
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            pages = list(self.mgr.iter_pages('nullable_paged', 'bucket', 7, config='embedded'))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        rows = [(row.bucket, row.id) for page in pages for row in page]
+        assert len(rows) == 100
+        assert rows == sorted(rows, key=lambda row: (row[0] is not None, row[0] or 0, row[1]))
+        # Plain column orders, which an index on the key can serve.
+        orders = [statement.split('ORDER BY')[1] for statement in statements if 'ORDER BY' in statement]
+        assert orders and all('NULL' not in order for order in orders)
+
+        bucket = sqlalchemy.column('bucket')
+        assert dialects.nulls_first(dialects.SQLITE, bucket) is bucket
+        assert str(dialects.nulls_first(dialects.POSTGRESQL, bucket)) == 'bucket NULLS FIRST'
+
+        pages = list(self.mgr.iter_pages('nullable_paged', ['bucket', 'id'], 10, where='id < 50', config='embedded'))
+        assert sum(len(page) for page in pages) == 50
+
+        pages = list(self.mgr.iter_pages('nullable_pairs', ['a', 'b'], 6, config='embedded'))
+        rows = [(row.a, row.b, row.id) for page in pages for row in page]
+        nulls_first = lambda value: (value is not None, value or 0)
+        assert rows == sorted(rows, key=lambda row: (nulls_first(row[0]), nulls_first(row[1]), row[2]))
+        assert len(rows) == 100
+
+    def test_limit_identity_maps(self):
+        with self.mgr.transaction('embedded') as db:
+            db.execute("CREATE TABLE loaded (id int PRIMARY KEY, value int)")
+            db.connection().execute(text("INSERT INTO loaded (id, value) VALUES (:id, :value)"),
+                                    [{'id': i, 'value': i} for i in range(100)])
+
+        limit = self.mgr.limit_identity_maps(max_objects=10)
+        try:
+            with self.mgr.connection('embedded') as db:
+                rows = db.loaded.all()
+                assert self.mgr.identity_map_size(db) == 10
+                assert rows[-1] in db.session and rows[0] not in db.session
+                assert rows[0].value == 0
+
+            self.mgr.limit_identity_maps(max_objects=None, expunge_on_commit=True)
+            with self.mgr.transaction('embedded', ConnectionLevel.UPDATE) as db:
+                held = db.loaded.all()
+                assert self.mgr.identity_map_size(db) == 100
+                db.commit()
+                assert self.mgr.identity_map_size(db) == 0
+            assert limit.expunged == 190
+        finally:
+            self.mgr.limit_identity_maps(max_objects=None)
+
+    def test_warm_up(self):
+        assert self.mgr.warm_up(workers=2) == {('embedded', ConnectionLevel.READ_ONLY): ['nope']}
+        engine = self.mgr._engine_for('embedded', ConnectionLevel.READ_ONLY)
+        metadata = self.mgr._metadata_for(engine)
+        assert 'test' in metadata.tables and 'reference' in metadata.tables
+
+        statements = []
+        event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        with self.mgr.connection('embedded') as db:
+            assert db.test.get(1).name == 'testing'
+        assert len(statements) == 1
+
+    def test_shared_handle_maps_once(self):
+        engine = self.mgr._engine_for('embedded', ConnectionLevel.READ_ONLY)
+
+        def slow_reflect(table):
+            # Every thread gets past the mapped-class cache before any of them maps.
+            time.sleep(0.05)
+            return self.mgr._reflect_table(engine, table)
+
+        db = reflection.SharedSoup(engine, self.mgr._metadata_for(engine), slow_reflect,
+                                   session=self.mgr._session)
+        mapped, errors = [], []
+
+        def count():
+            try:
+                mapped.append(db.entity('test'))
+                assert db.test.count() >= 1
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+            finally:
+                db.session.remove()
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == [] and len(set(mapped)) == 1
+
+    def test_dropped_engines_are_collected(self):
+        mgr = Manager(self.mgr.config_stream)
+        mgr.set_db_config('embedded')
+        db = mgr.get_connection(mgr.config_stream, validate=True)
+        assert db.test.get(1).name == 'testing'
+        engine = weakref.ref(mgr.db_engine)
+        mgr.get_entity('test', 1, 'embedded')
+        mgr.release()
+        del db
+        mgr.unset_engine()
+        gc.collect()
+        assert engine() is None
+        assert mgr._engine_metadata and not mgr._entity_connections
+        mgr.close()
+        assert not mgr._engine_metadata
+
+    def test_refresh_schema(self):
+        with self.mgr.transaction('embedded', ConnectionLevel.ADMIN) as db:
+            db.execute("CREATE TABLE altered (id int PRIMARY KEY)")
+        with self.mgr.connection('embedded') as db:
+            assert 'note' not in db.altered.c
+        with self.mgr.transaction('embedded', ConnectionLevel.ADMIN) as db:
+            db.execute("ALTER TABLE altered ADD COLUMN note varchar(45)")
+
+        assert 'altered' in self.mgr.refresh_schema('embedded')
+        with self.mgr.connection('embedded') as db:
+            assert 'note' in db.altered.c
@@ -0,0 +1,79 @@
+from nose.tools import assert_raises
+
+from sqlconmanager import dialects
+from sqlconmanager.connection_manager import Manager, ManagerConnectionException
+
+TIMEOUT_CONFIG = '''
+database_configurations:
+    embedded:
+        dbtype: sqlite
+        dbname: ":memory:"
+'''
+
+
+class _Result(object):
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class _PooledConnection(object):
+    def __init__(self, info):
+        self.info = info
+
+
+class _Connection(object):
+    '''Stands in for a SQLAlchemy Connection (and a SQLSoup handle): records the statements.'''
+
+    def __init__(self, dialect, info=None):
+        self.dialect = type('Dialect', (object,), {'name': dialect})
+        self.connection = _PooledConnection(info or {})
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        return _Result(42)
+
+
+class _Soup(object):
+    def __init__(self, connection):
+        self._connection = connection
+
+    def connection(self):
+        return self._connection
+
+
+class TestStatementTimeouts():
+    '''Statement timeouts, backend ids and cancel().'''
+
+    def test_timeout_statements(self):
+        assert dialects.session_setup_statements(dialects.MYSQL, 2.5) == ['SET SESSION max_execution_time = 2500']
+        assert dialects.session_setup_statements(dialects.POSTGRESQL, 2.5) == ['SET statement_timeout = 2500']
+        assert dialects.session_setup_statements(dialects.SQLITE, 2.5, {'query_only': 1}) == \
+            ['PRAGMA query_only = 1']
+        # Nothing to run, so new connections cost no extra round trip.
+        assert dialects.session_setup_statements(dialects.MYSQL) == []
+
+    def test_backend_id_is_looked_up_once(self):
+        connection = _Connection(dialects.MYSQL)
+        assert dialects.backend_id(dialects.MYSQL, connection) == 42
+        assert dialects.backend_id(dialects.MYSQL, connection) == 42
+        assert connection.statements == ['SELECT CONNECTION_ID()']
+
+        connection = _Connection(dialects.SQLITE)
+        assert dialects.backend_id(dialects.SQLITE, connection) is None
+        assert connection.statements == []
+
+    def test_backend_id_records_the_host(self):
+        mgr = Manager(TIMEOUT_CONFIG)
+        backend_id = mgr.backend_id(_Soup(_Connection(dialects.POSTGRESQL, {'host': ('db2', 5432)})))
+        assert backend_id == 42 and backend_id.host == ('db2', 5432)
+        assert not isinstance(mgr.backend_id(_Soup(_Connection(dialects.POSTGRESQL))), dialects.BackendId)
+
+    def test_cancel_errors(self):
+        mgr = Manager(TIMEOUT_CONFIG)
+        assert_raises(ManagerConnectionException, mgr.cancel, 42, 'nope')
+        # SQLite has no statement cancellation.
+        assert_raises(ManagerConnectionException, mgr.cancel, 42, 'embedded')
@@ -0,0 +1,39 @@
+from nose.tools import assert_raises
+
+from sqlconmanager.web import ReleaseConnectionsMiddleware
+
+
+class CountingManager(object):
+    def __init__(self):
+        self.released = 0
+
+    def release(self):
+        self.released += 1
+
+
+def hello_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'hello']
+
+
+def failing_app(environ, start_response):
+    raise RuntimeError('boom')
+
+
+class TestReleaseConnectionsMiddleware():
+    '''Connections are released when the response is closed, not before.'''
+
+    def test_release_on_close(self):
+        manager = CountingManager()
+        app = ReleaseConnectionsMiddleware(hello_app, manager)
+        result = app({}, lambda status, headers: None)
+        assert list(result) == [b'hello']
+        assert manager.released == 0
+        result.close()
+        assert manager.released == 1
+
+    def test_release_on_error(self):
+        manager = CountingManager()
+        app = ReleaseConnectionsMiddleware(failing_app, manager)
+        assert_raises(RuntimeError, app, {}, lambda status, headers: None)
+        assert manager.released == 1
@@ -0,0 +1,203 @@
+'''Table copies between database configurations: parallel primary-key ranges, streamed
+reads, batched inserts and resumable checkpoints.'''
+
+import json
+import logging
+import os
+import threading
+
+import sqlalchemy
+import sqlalchemy.sql.visitors
+
+from concurrent import futures
+
+from sqlconmanager import dialects
+from sqlconmanager.exceptions import ManagerConnectionException
+
+logger = logging.getLogger(__name__)
+
+COPY_BATCH_SIZE = 5000  # rows per insert transaction (and checkpoint)
+COPY_WORKERS = 4
+COPY_RANGES_PER_WORKER = 4  # more ranges than workers, so one dense range does not hold up the copy
+
+
+class Checkpoint(object):
+    '''Progress of a copy, one [low, high, last copied key, done] entry per range, kept in
+    a JSON file (replaced atomically) so an interrupted copy can resume.'''
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.ranges = None
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+            if state.get('signature') != signature:
+                raise ManagerConnectionException('Checkpoint {0} belongs to another copy: {1}'.format(
+                    path, state.get('signature')))
+            self.ranges = state['ranges']
+
+    def start(self, ranges):
+        self.ranges = [[low, high, None, False] for low, high in ranges]
+        self._save()
+
+    def update(self, index, last=None, done=False):
+        with self._lock:
+            if last is not None:
+                self.ranges[index][2] = last
+            self.ranges[index][3] = done
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump({'signature': self.signature, 'ranges': self.ranges}, checkpoint_file)
+        os.rename(temporary, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _in_range(column, low, high):
+    clauses = []
+    if low is not None:
+        clauses.append(column >= low)
+    if high is not None:
+        clauses.append(column < high)
+    return clauses
+
+
+def _for_table(clause, src_table, dst_table):
+    '''clause with the columns of src_table replaced by the same-named columns of dst_table.'''
+
+    def replace(element):
+        if isinstance(element, sqlalchemy.Column) and element.table is src_table:
+            return dst_table.c[element.name]
+        return None
+
+    return sqlalchemy.sql.visitors.replacement_traverse(clause, {}, replace)
+
+
+def key_ranges(engine, table, key, where, count):
+    '''Split the keys of table matching where into up to count [low, high) ranges.
+
+    Only integer keys are split (evenly over min..max); other keys get one open range.
+    '''
+
+    column = table.c[key]
+    if count < 2 or not isinstance(column.type, sqlalchemy.types.Integer):
+        return [(None, None)]
+
+    query = sqlalchemy.select([sqlalchemy.func.min(column), sqlalchemy.func.max(column)])
+    if where is not None:
+        query = query.where(where)
+    with engine.connect() as connection:
+        low, high = connection.execute(query).first()
+    if low is None:
+        return [(None, None)]
+
+    step = max(1, (high - low + count) // count)
+    bounds = list(range(low, high + 1, step)) + [high + 1]
+    return [(start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def copy_range(src_engine, src_table, dst_engine, dst_table, key, where, low, high, after=None,
+               batch_size=COPY_BATCH_SIZE, on_batch=None):
+    '''Copy the rows of src_table with low <= key < high (and key > after), in key order.
+
+    Rows are read from one streamed (server-side cursor) query, in a transaction of the
+    source connection (see dialects.streaming), and inserted in transactions of
+    batch_size rows; on_batch(last key, rows) is called after each commit.
+    Returns the number of rows copied.
+    '''
+
+    column = src_table.c[key]
+    columns = [src_table.c[c.name] for c in dst_table.columns if c.name in src_table.c]
+    query = sqlalchemy.select(columns).order_by(column)
+    clauses = _in_range(column, low, high)
+    if after is not None:
+        clauses.append(column > after)
+    if where is not None:
+        clauses.append(where)
+    if clauses:
+        query = query.where(sqlalchemy.and_(*clauses))
+
+    copied = 0
+    with src_engine.connect() as src_connection:
+        src_connection = dialects.streaming(src_connection)
+        with src_connection.begin():
+            result = src_connection.execution_options(stream_results=True).execute(query)
+            try:
+                while True:
+                    rows = [dict(row) for row in result.fetchmany(batch_size)]
+                    if not rows:
+                        break
+                    with dst_engine.begin() as dst_connection:
+                        dst_connection.execute(dst_table.insert(), rows)
+                    copied += len(rows)
+                    if on_batch is not None:
+                        on_batch(rows[-1][key], len(rows))
+            finally:
+                result.close()
+    return copied
+
+
+def copy_table(src_engine, src_table, dst_engine, dst_table, where=None, workers=COPY_WORKERS,
+               batch_size=COPY_BATCH_SIZE, checkpoint=None):
+    '''Copy the rows of src_table matching where into dst_table, over workers key ranges in parallel.
+
+    checkpoint is a Checkpoint (or None): with one whose file already exists, finished
+    ranges are skipped and the others resume after their last checkpointed key, once the
+    rows of dst_table past it (copied after the checkpoint was written) are deleted.
+    That delete is limited to the range and to where; when neither bounds it (one open
+    range, nothing checkpointed, no where), it is skipped rather than emptying dst_table.
+    Returns the number of rows copied.
+    '''
+
+    primary_key = list(src_table.primary_key.columns)
+    if len(primary_key) != 1:
+        raise ManagerConnectionException('Table {0} needs a single-column primary key to be copied'.format(
+            src_table.name))
+    key = primary_key[0].name
+
+    if checkpoint is None:
+        checkpoint = Checkpoint(None, None)
+    resuming = checkpoint.ranges is not None
+    if resuming:
+        logger.info('Resuming copy of {0} from {1}'.format(src_table.name, checkpoint.path))
+    else:
+        checkpoint.start(key_ranges(src_engine, src_table, key, where, workers * COPY_RANGES_PER_WORKER))
+
+    def copy_one(index):
+        low, high, last, done = checkpoint.ranges[index]
+        if done:
+            return 0
+        if resuming:
+            clauses = _in_range(dst_table.c[key], low, high)
+            if last is not None:
+                clauses.append(dst_table.c[key] > last)
+            if where is not None:
+                clauses.append(_for_table(where, src_table, dst_table))
+            if clauses:
+                with dst_engine.begin() as connection:
+                    connection.execute(dst_table.delete().where(sqlalchemy.and_(*clauses)))
+            else:
+                logger.warning('Not clearing {0}: the unfinished range is unbounded'.format(dst_table.name))
+        copied = copy_range(src_engine, src_table, dst_engine, dst_table, key, where, low, high, last, batch_size,
+                            lambda last_key, rows: checkpoint.update(index, last_key))
+        checkpoint.update(index, done=True)
+        return copied
+
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        copied = sum(future.result() for future in
+                     [executor.submit(copy_one, index) for index in range(len(checkpoint.ranges))])
+    finally:
+        executor.shutdown(wait=True)
+
+    checkpoint.remove()
+    return copied
@@ -0,0 +1,48 @@
+'''WSGI and Flask hooks returning a request's connections to the pool when it ends.'''
+
+
+class _ClosingIterable(object):
+    '''Response iterable that calls a callback once the server has closed the response.'''
+
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
+class ReleaseConnectionsMiddleware(object):
+    '''WSGI middleware calling manager.release() after each response has been sent.
+
+        application = ReleaseConnectionsMiddleware(application, manager)
+    '''
+
+    def __init__(self, app, manager):
+        self.app = app
+        self.manager = manager
+
+    def __call__(self, environ, start_response):
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            self.manager.release()
+            raise
+        return _ClosingIterable(result, self.manager.release)
+
+
+def init_flask(app, manager):
+    '''Release the request's connections on Flask application context teardown.'''
+
+    @app.teardown_appcontext
+    def release_connections(exception=None):  # pylint: disable=unused-argument
+        manager.release()
+
+    return release_connections